@@ -9,6 +9,8 @@ fens2cdb="$script_dir/../fens2cdb.py"
 default_concurrency=32
 default_size=100000
 concurrency=$default_concurrency
+max_concurrency_flag=""
+rate_limit_flag=""
 size=$default_size
 reverse_flag=""
 ee_flag="-ee"
@@ -19,6 +21,14 @@ while [[ $# -gt 0 ]]; do
         concurrency="$2"
         shift 2
         ;;
+    -m | --maxConcurrency)
+        max_concurrency_flag="--maxConcurrency $2"
+        shift 2
+        ;;
+    -l | --rateLimit)
+        rate_limit_flag="--rateLimit $2"
+        shift 2
+        ;;
     -s | --size)
         size="$2"
         shift 2
@@ -35,6 +45,8 @@ while [[ $# -gt 0 ]]; do
         echo "Usage: $0 [OPTIONS] file.epd(.gz)"
         echo "Options:"
         echo "  -c, --concurrency CONCURRENCY   Set the concurrency level (default: $default_concurrency)"
+        echo "  -m, --maxConcurrency MAX        Adapt the concurrency between 1 and MAX, starting at CONCURRENCY"
+        echo "  -l, --rateLimit RATE            Requests per second, shared with other cdblib scripts on this host"
         echo "  -s, --size SIZE                 Set the chunk size (default: $default_size)"
         echo "  -r, --reverse                   Process the chunks in reverse order"
         echo "  -q, --quick                     Queue each unknown position only once"
@@ -89,7 +101,7 @@ find ./ -type f -regex "./_tmp_jumbo_${namehash}_${size}_[0-9]*$" | sort $revers
     if [ -e "$output_file" ] && [ "$(wc -l <"$output_file")" -eq "$(wc -l <"$chunk")" ]; then
         echo "Chunk '$chunk' already processed completely. Skipping."
     else
-        python "$fens2cdb" -s -c "$concurrency" "$ee_flag" "$chunk" >"$output_file"
+        python "$fens2cdb" -s -c "$concurrency" $max_concurrency_flag $rate_limit_flag "$ee_flag" "$chunk" >"$output_file"
     fi
 done
 
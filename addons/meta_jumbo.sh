@@ -8,6 +8,8 @@ jumbo="$script_dir/jumbo_fens2cdb.sh"
 score_locally="$script_dir/score_fens_locally.py"
 
 concurrency=""
+max_concurrency=""
+rate_limit=""
 size=""
 reverse_flag=""
 
@@ -17,6 +19,14 @@ while [[ $# -gt 0 ]]; do
         concurrency="--concurrency $2"
         shift 2
         ;;
+    -m | --maxConcurrency)
+        max_concurrency="--maxConcurrency $2"
+        shift 2
+        ;;
+    -l | --rateLimit)
+        rate_limit="--rateLimit $2"
+        shift 2
+        ;;
     -s | --size)
         size="--size $2"
         shift 2
@@ -29,6 +39,8 @@ while [[ $# -gt 0 ]]; do
         echo "Usage: $0 [OPTIONS] file.epd(.gz)"
         echo "Options:"
         echo "  -c, --concurrency CONCURRENCY   Optional parameter passed to jumbo_fens2cdb.sh"
+        echo "  -m, --maxConcurrency MAX        Optional parameter passed to jumbo_fens2cdb.sh"
+        echo "  -l, --rateLimit RATE            Optional parameter passed to jumbo_fens2cdb.sh"
         echo "  -s, --size SIZE                 Optional parameter passed to jumbo_fens2cdb.sh"
         echo "  -r, --reverse                   Optional parameter passed to jumbo_fens2cdb.sh"
         echo
@@ -91,7 +103,7 @@ while [ $count_unknown -ne 0 ]; do
     fi
 
     if [ $count_unknown -ne 0 ]; then
-        $jumbo $concurrency $size $reverse_flag --quick "$meta_unknown"
+        $jumbo $concurrency $max_concurrency $rate_limit $size $reverse_flag --quick "$meta_unknown"
         if [[ ! -f $meta_unknown_cdb ]]; then
             echo "Fatal error: Cannot find '$meta_unknown_cdb'."
             exit 1
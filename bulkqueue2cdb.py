@@ -15,59 +15,45 @@ class bulk2cdb:
         self.plyEnd = args.plyEnd
         self.pieceMin = args.pieceMin
         self.pieceMax = args.pieceMax
-        print(f"Loading games from {len(args.filenames)} file(s) ...", flush=True)
-        self.tic = time.time()
-        self.fens = set()
+        self.filenames = args.filenames
+        self.outFile = args.outFile
+        # the positions are streamed from the files to cdb, and only their
+        # 64-bit keys are kept to find the unique ones
+        self.keys = cdblib.PositionKeySet()
         self.gameCount = 0
-        for f in args.filenames:
-            epds, count = self.load_epds(f)
-            self.fens.update(epds)
-            self.gameCount += count
-        elapsed = time.time() - self.tic
-        print(f"Done. Parsed {self.gameCount} games/lines in {elapsed:.1f}s.")
-        print(
-            f"Found {len(self.fens)} unique positions from {self.gameCount} games/lines in {len(args.filenames)} file(s) to send to cdb.",
-            flush=True,
+        self.cdb = cdblib.cdbAPI(
+            args.concurrency, args.user, not args.suppressErrors, args.transport
         )
-        if args.outFile:
-            fens = sorted(list(self.fens))
-            with open(args.outFile, "w") as f:
-                for fen in fens:
-                    f.write(fen + "\n")
-            print(f"Wrote the unique positions to {args.outFile}.")
-
-        self.cdb = cdblib.cdbAPI(args.concurrency, args.user, not args.suppressErrors)
-
-    def load_epds(self, filename):
-        """returns a set of unique EPDs found in the given file"""
-        epdlist = []
+
+    def read_lines(self, filename):
+        """yields the games/lines in the file as (extended) EPDs"""
         if filename.endswith(".pgn") or filename.endswith(".pgn.gz"):
             pgn = open_file_rt(filename)
             logging.getLogger("chess.pgn").setLevel(logging.CRITICAL)
             while True:
-                game = chess.pgn.read_game(pgn)
-                if game is None:
-                    break
-                for e in game.errors:
-                    if isinstance(e, chess.IllegalMoveError):
-                        move = str(e).split(":")[-1].strip()
-                        print(f"Ignoring illegal move {move}")
-                    else:
-                        print(f'Encountered error "{e}". Will try to continue.')
-                epd = game.board().epd()  # ignore move counters
-                epdMoves = " moves"
-                for m in game.mainline_moves():
-                    epdMoves += f" {m}"
-                if epdMoves != " moves":
-                    epd += epdMoves
-                epdlist.append(epd)
-            print(f"Loaded {len(epdlist)} games from file {filename}.")
+                with cdblib.PROFILER.stage("parse"):
+                    game = chess.pgn.read_game(pgn)
+                    if game is None:
+                        break
+                    for e in game.errors:
+                        if isinstance(e, chess.IllegalMoveError):
+                            move = str(e).split(":")[-1].strip()
+                            print(f"Ignoring illegal move {move}")
+                        else:
+                            print(f'Encountered error "{e}". Will try to continue.')
+                    epd = game.board().epd()  # ignore move counters
+                    epdMoves = " moves"
+                    for m in game.mainline_moves():
+                        epdMoves += f" {m}"
+                    if epdMoves != " moves":
+                        epd += epdMoves
+                yield epd
         else:
             with open_file_rt(filename) as f:
                 for line in f:
-                    line = line.strip()
-                    if line:
-                        if line.startswith("#"):  # ignore comments
+                    with cdblib.PROFILER.stage("load"):
+                        line = line.strip()
+                        if not line or line.startswith("#"):  # ignore comments
                             continue
                         line = line.split(";")[0]  # ignore epd opcodes
                         epd, _, moves = line.partition("moves")
@@ -86,67 +72,92 @@ class bulk2cdb:
                             epdMoves += f" {m}"
                         if epdMoves != " moves":
                             epd += epdMoves
-                        epdlist.append(epd)
-            print(f"Loaded {len(epdlist)} (extended) EPDs from file {filename}.")
-
-        epds = set()  # use a set to filter duplicates
-        for i, epd in enumerate(epdlist):
-            if self.verbose >= 2:
-                print(f"Line {i}: {epd}")
-            epd, _, moves = epd.partition(" moves")
-            moves = [None] + moves.split()  # to be able to use plyBegin=0 for epd
-            plyB = (
-                0
-                if self.plyBegin is None
-                else max(0, self.plyBegin + len(moves))
-                if self.plyBegin < 0
-                else min(self.plyBegin, len(moves))
-            )
-            plyE = (
-                len(moves)
-                if self.plyEnd is None
-                else max(0, self.plyEnd + len(moves))
-                if self.plyEnd < 0
-                else min(self.plyEnd, len(moves))
+                    yield epd
+
+    def new_epds(self, epd):
+        """returns the new unique EPDs along the (extended) EPD epd"""
+        epd, _, moves = epd.partition(" moves")
+        moves = [None] + moves.split()  # to be able to use plyBegin=0 for epd
+        plyB = (
+            0
+            if self.plyBegin is None
+            else max(0, self.plyBegin + len(moves))
+            if self.plyBegin < 0
+            else min(self.plyBegin, len(moves))
+        )
+        plyE = (
+            len(moves)
+            if self.plyEnd is None
+            else max(0, self.plyEnd + len(moves))
+            if self.plyEnd < 0
+            else min(self.plyEnd, len(moves))
+        )
+        board = cdblib.ZobristBoard(epd)
+        c, new = 0, []
+        for ply, m in enumerate(moves):
+            if m is not None:
+                board.push(chess.Move.from_uci(m))
+            pc = chess.popcount(board.occupied)  # piece count
+            if ply >= plyE or pc < self.pieceMin or not bool(board.legal_moves):
+                break
+            if (
+                plyB <= ply
+                and ply < plyE
+                and self.pieceMin <= pc
+                and pc <= self.pieceMax
+            ):
+                if self.keys.add(board.zobrist):
+                    new.append(board.epd())
+                c += 1
+        if self.verbose:
+            print(f" ... found {c} positions.")
+        return new
+
+    def load_epds(self):
+        """yields the new unique EPDs from all the files"""
+        for filename in self.filenames:
+            pgn = filename.endswith(".pgn") or filename.endswith(".pgn.gz")
+            lines = new = 0
+            for i, epd in enumerate(self.read_lines(filename)):
+                if self.verbose >= 2:
+                    print(f"Line {i}: {epd}")
+                lines += 1
+                with cdblib.PROFILER.stage("replay"):
+                    epds = self.new_epds(epd)
+                new += len(epds)
+                yield from epds
+            self.gameCount += lines
+            print(
+                f"Loaded {lines} {'games' if pgn else '(extended) EPDs'} from file {filename}, with {new} new unique positions.",
+                flush=True,
             )
-            board = chess.Board(epd)
-            c = 0
-            for ply, m in enumerate(moves):
-                if m is not None:
-                    board.push(chess.Move.from_uci(m))
-                pc = chess.popcount(board.occupied)  # piece count
-                if ply >= plyE or pc < self.pieceMin or not bool(board.legal_moves):
-                    break
-                if (
-                    plyB <= ply
-                    and ply < plyE
-                    and self.pieceMin <= pc
-                    and pc <= self.pieceMax
-                ):
-                    epds.add(board.epd())
-                    c += 1
-            if self.verbose:
-                print(f" ... found {c} positions.")
-
-        print(f"Loaded {len(epds)} unique EPDs from file {filename}.")
-        return epds, len(epdlist)
 
     async def parse_all(self):
         print(
-            f"Started parsing the FENs with concurrency {self.concurrency} ...",
+            f"Loading games from {len(self.filenames)} file(s) and queueing their positions with concurrency {self.concurrency} ...",
             flush=True,
         )
         self.tic = time.time()
-        tasks = []
-        for fen in self.fens:
-            tasks.append(asyncio.create_task(self.parse_single_fen(fen)))
+        out = open(self.outFile, "w") if self.outFile else None
+        epds = self.load_epds()
 
-        for parse_fen in tasks:
-            await parse_fen
+        async def worker():
+            # the workers share the generator, which reads the files lazily
+            for fen in epds:
+                if out is not None:
+                    with cdblib.PROFILER.stage("write"):
+                        out.write(fen + "\n")
+                await self.parse_single_fen(fen)
+
+        # more workers than connections, as some of them may be backing off
+        await asyncio.gather(*(worker() for _ in range(4 * self.concurrency)))
+        if out is not None:
+            out.close()
+            print(f"Wrote the unique positions to {self.outFile}.")
 
         elapsed = time.time() - self.tic
         print(
-            f"Done. Queued {len(self.fens)} FENs from {self.gameCount} games in {elapsed:.1f}s."
+            f"Done. Queued {len(self.keys)} unique positions from {self.gameCount} games/lines in {len(self.filenames)} file(s) in {elapsed:.1f}s."
         )
 
     async def parse_single_fen(self, fen):
@@ -174,7 +185,7 @@ async def main():
     parser.add_argument(
         "-o",
         "--outFile",
-        help="Filename to write unique FENs to.",
+        help="Filename to write the unique FENs to, in the order in which they are found.",
         default=None,
     )
     parser.add_argument(
@@ -226,7 +237,19 @@ async def main():
         action="store_true",
         help="Suppress error messages from cdblib.",
     )
+    parser.add_argument(
+        "--transport",
+        choices=["requests", "asyncio"],
+        default="requests",
+        help="HTTP backend: blocking requests in a thread pool, or native asyncio.",
+    )
+    parser.add_argument(
+        "--profile",
+        help="Write a profile of the run to this file: the time spent in the local stages and waiting for cdb, a CPU profile and the peak memory.",
+        default=None,
+    )
     args = parser.parse_args()
+    cdblib.PROFILER.start(args.profile)
     p2c = bulk2cdb(args)
     await p2c.parse_all()
 
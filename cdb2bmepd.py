@@ -6,12 +6,22 @@ import argparse, asyncio, sys, time, cdblib
 
 class cdb2bm:
     def __init__(
-        self, filename, output, gap, drawGap, quiet, concurrency, user, suppressErrors
+        self,
+        filename,
+        output,
+        gap,
+        drawGap,
+        quiet,
+        concurrency,
+        user,
+        suppressErrors,
+        cache=None,
+        prefillChildren=False,
     ):
         self.input = filename
         self.lines = []
         self.loaded = 0
-        with cdblib.open_file_rt(filename) as f:
+        with cdblib.PROFILER.stage("load"), cdblib.open_file_rt(filename) as f:
             for line in f:
                 line = line.strip()
                 if line:
@@ -35,7 +45,9 @@ class cdb2bm:
         self.gap = gap
         self.drawGap = drawGap
         self.concurrency = concurrency
-        self.cdb = cdblib.cdbAPI(concurrency, user, not suppressErrors)
+        if prefillChildren:
+            cache = cdblib.ResponseCache(cache or ":memory:", prefillChildren=True)
+        self.cdb = cdblib.cdbAPI(concurrency, user, not suppressErrors, cache=cache)
         self.filtered = cdblib.AtomicInteger()
 
     def best_move(self, movelist):
@@ -81,7 +93,8 @@ class cdb2bm:
             for parse_line in tasks:
                 l = await parse_line
                 if l:
-                    print(l, file=self.output)
+                    with cdblib.PROFILER.stage("write"):
+                        print(l, file=self.output)
 
         if self.display:
             elapsed = time.time() - self.tic
@@ -99,10 +112,11 @@ class cdb2bm:
             return line
         fen = " ".join(line.split()[:4])  # cdb ignores move counters anyway
         r = await self.cdb.queryall(fen)
-        bm, s = self.best_move(r["moves"]) if "moves" in r else (None, "")
-        if bm:
-            self.filtered.inc()
-        return f'{fen} bm {bm}; c0 "{s}";' if bm else ""
+        with cdblib.PROFILER.stage("format"):
+            bm, s = self.best_move(r["moves"]) if "moves" in r else (None, "")
+            if bm:
+                self.filtered.inc()
+            return f'{fen} bm {bm}; c0 "{s}";' if bm else ""
 
 
 async def main():
@@ -138,6 +152,16 @@ async def main():
         type=int,
         default=16,
     )
+    parser.add_argument(
+        "--cache",
+        help="Filename of a persistent SQLite cache for cdb's replies, which may be shared between runs and scripts.",
+        default=None,
+    )
+    parser.add_argument(
+        "--prefillChildren",
+        action="store_true",
+        help="Use the move scores in cdb's queryall/showall replies to answer queryscore requests with learn=0 for the child positions, e.g. from fens2cdb --suppressLearning with the same --cache file.",
+    )
     parser.add_argument(
         "-b",
         "--batchSize",
@@ -156,7 +180,13 @@ async def main():
         action="store_true",
         help="Suppress error messages from cdblib.",
     )
+    parser.add_argument(
+        "--profile",
+        help="Write a profile of the run to this file: the time spent in the local stages and waiting for cdb, a CPU profile and the peak memory.",
+        default=None,
+    )
     args = parser.parse_args()
+    cdblib.PROFILER.start(args.profile)
 
     if args.drawGap is None:
         args.drawGap = max(args.gap // 2, 1)
@@ -170,6 +200,8 @@ async def main():
         args.concurrency,
         args.user,
         args.suppressErrors,
+        args.cache,
+        args.prefillChildren,
     )
 
     await c2b.parse_all(args.batchSize)
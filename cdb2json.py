@@ -11,7 +11,7 @@ class cdb2json:
         self.input = filename
         self.lines = []
         self.loaded = 0
-        with cdblib.open_file_rt(filename) as f:
+        with cdblib.PROFILER.stage("load"), cdblib.open_file_rt(filename) as f:
             for line in f:
                 line = line.strip()
                 if line and not line.startswith("#"):  # ignore comments
@@ -63,7 +63,10 @@ class cdb2json:
                         flush=True,
                     )
 
-        print(json.dumps(self.json), file=self.output)
+        with cdblib.PROFILER.stage("format"):
+            output = json.dumps(self.json)
+        with cdblib.PROFILER.stage("write"):
+            print(output, file=self.output)
 
         if self.display:
             elapsed = time.time() - self.tic
@@ -78,9 +81,10 @@ class cdb2json:
         d.pop("fen")
         if self.retainAll:
             return fen, d
-        moves = []
-        for m in d.get("moves", []):
-            moves.append({"uci": m.get("uci", None), "score": m.get("score", None)})
+        with cdblib.PROFILER.stage("format"):
+            moves = []
+            for m in d.get("moves", []):
+                moves.append({"uci": m.get("uci", None), "score": m.get("score", None)})
         return fen, {"moves": moves}
 
 
@@ -128,7 +132,13 @@ async def main():
         action="store_true",
         help="Suppress error messages from cdblib.",
     )
+    parser.add_argument(
+        "--profile",
+        help="Write a profile of the run to this file: the time spent in the local stages and waiting for cdb, a CPU profile and the peak memory.",
+        default=None,
+    )
     args = parser.parse_args()
+    cdblib.PROFILER.start(args.profile)
 
     c2j = cdb2json(
         args.input,
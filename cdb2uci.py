@@ -3,6 +3,8 @@ import argparse, asyncio, sys, time, cdblib, chess
 VERSION = "cdb2uci engine 0.95"
 VALUE_MATE = 30000
 VALUE_TBWIN = 25000
+# the engine's requests must not wait behind bulk traffic of a shared client
+PRIORITY = cdblib.PRIORITY_INTERACTIVE
 
 
 def score2mate(score):
@@ -16,7 +18,22 @@ def score2mate(score):
 class Engine:
     def __init__(self, args):
         self.cdb = cdblib.cdbAPI(
-            concurrency=args.concurrency, user=VERSION, showErrors=False
+            concurrency=args.concurrency,
+            user=VERSION,
+            showErrors=False,
+            warmup=args.warmup,
+            rateLimit=args.rateLimit,
+            rateWeight=args.rateWeight,
+            hedgeFraction=args.hedgeFraction,
+            cache=(
+                cdblib.ResponseCache(
+                    args.cache or ":memory:",
+                    prefillChildren=args.prefillChildren,
+                    prefillPVs=args.prefillPVs,
+                )
+                if args.prefillChildren or args.prefillPVs
+                else args.cache
+            ),
         )
         print(VERSION, flush=True)
         self.enqueue = args.enqueue
@@ -29,7 +46,7 @@ class Engine:
     async def query_cdb_for_movelist(self):
         if self.debug:
             print(f"info string Querying cdb for FEN {self.board.epd()}", flush=True)
-        r = await self.cdb.showall(self.board.epd())
+        r = await self.cdb.showall(self.board.epd(), PRIORITY)
         if self.debug:
             print(f"info string Obtained result {r}", flush=True)
         while "status" not in r or "moves" not in r or r["status"] != "ok":
@@ -39,7 +56,7 @@ class Engine:
                     f"info string Re-querying cdb for FEN {self.board.epd()}",
                     flush=True,
                 )
-            r = await self.cdb.showall(self.board.epd())
+            r = await self.cdb.showall(self.board.epd(), PRIORITY)
             if self.debug:
                 print(f"info string Obtained result {r}", flush=True)
             print(
@@ -84,7 +101,7 @@ class Engine:
         while not tb_with_cr and self.enqueue and movelist[0][1] is None:
             if self.debug:
                 print(f"info string Queueing FEN {self.board.epd()}", flush=True)
-            await self.cdb.queue(self.board.epd())
+            await self.cdb.queue(self.board.epd(), PRIORITY)
             if self.enqueue < 2:
                 break
             await asyncio.sleep(1)
@@ -123,7 +140,9 @@ class Engine:
             if self.querypv:
                 self.board.push_uci(r[i][0])
                 tasks.append(
-                    asyncio.create_task(self.cdb.querypvstable(self.board.epd())),
+                    asyncio.create_task(
+                        self.cdb.querypvstable(self.board.epd(), PRIORITY)
+                    ),
                 )
                 self.board.pop()
         for idx, query in enumerate(tasks):
@@ -219,6 +238,45 @@ async def main():
         type=int,
         default=8,
     )
+    parser.add_argument(
+        "--warmup",
+        help="Number of connections to cdb to open on engine start-up, so that the first go command does not pay for the connection setup.",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--rateLimit",
+        help="Maximum number of requests per second to cdb, shared by all the cdblib scripts on this host that use this option.",
+        type=float,
+        default=None,
+    )
+    parser.add_argument(
+        "--rateWeight",
+        help="Weight of this process in the split of the shared rate limit.",
+        type=float,
+        default=1,
+    )
+    parser.add_argument(
+        "--hedgeFraction",
+        help="Maximal fraction of read-only requests that may be duplicated if they are slower than usual, to cut tail latency. Duplicates only use idle connections and rate limit tokens, but each one is an extra request to cdb.",
+        type=float,
+        default=0,
+    )
+    parser.add_argument(
+        "--cache",
+        help="Filename of a persistent SQLite cache for cdb's replies, which may be shared between runs and scripts.",
+        default=None,
+    )
+    parser.add_argument(
+        "--prefillChildren",
+        action="store_true",
+        help="Use the move scores in cdb's queryall/showall replies to answer queryscore requests with learn=0 for the child positions, e.g. from fens2cdb --suppressLearning with the same --cache file.",
+    )
+    parser.add_argument(
+        "--prefillPVs",
+        action="store_true",
+        help="Use the PVs in cdb's replies to also answer stable PV requests for the positions along these PVs.",
+    )
     parser.add_argument(
         "--epd",
         help="Extended EPD of board on engine start-up.",
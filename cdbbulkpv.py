@@ -3,20 +3,40 @@ import chess, chess.pgn, cdblib
 
 
 class bulkpv:
-    def __init__(self, filename, stable, san, concurrency, user, suppressErrors):
+    def __init__(
+        self,
+        filename,
+        stable,
+        san,
+        concurrency,
+        user,
+        suppressErrors,
+        hedgeFraction=0,
+        cache=None,
+        prefillPVs=False,
+    ):
         self.filename = filename
         self.stable = stable
         self.isPGN = filename.endswith(".pgn") or filename.endswith(".pgn.gz")
         self.san = san if self.isPGN else False
         self.concurrency = concurrency
-        self.cdb = cdblib.cdbAPI(concurrency, user, not suppressErrors)
+        if prefillPVs:
+            cache = cdblib.ResponseCache(cache or ":memory:", prefillPVs=True)
+        self.cdb = cdblib.cdbAPI(
+            concurrency,
+            user,
+            not suppressErrors,
+            hedgeFraction=hedgeFraction,
+            cache=cache,
+        )
 
     def reload(self):
         self.metalist = []
         if self.isPGN:
             pgn = cdblib.open_file_rt(self.filename)
-            while game := chess.pgn.read_game(pgn):
-                self.metalist.append(game)
+            with cdblib.PROFILER.stage("parse"):
+                while game := chess.pgn.read_game(pgn):
+                    self.metalist.append(game)
             self.count = len(self.metalist)
             print(
                 f"Read {self.count} (opening) lines from file {self.filename}.",
@@ -25,7 +45,8 @@ class bulkpv:
             )
         else:
             comments = 0
-            with cdblib.open_file_rt(self.filename) as f:
+            load = cdblib.PROFILER.stage("load")
+            with load, cdblib.open_file_rt(self.filename) as f:
                 for line in f:
                     line = line.strip()
                     if line:
@@ -55,17 +76,22 @@ class bulkpv:
                 tasks.append(asyncio.create_task(self.parse_single_line(line)))
 
             for parse_line in tasks:
-                print(await parse_line)
+                line = await parse_line
+                with cdblib.PROFILER.stage("write"):
+                    print(line)
 
         elapsed = time.time() - self.tic
         print(
             f"Done. Polled {self.count} positions in {elapsed:.1f}s.",
             file=sys.stderr,
         )
+        if self.cdb.cache is not None:
+            print(self.cdb.cache.stats(), file=sys.stderr)
 
     async def parse_single_line(self, line):
         if self.isPGN:
-            epd = line.end().board().epd()
+            with cdblib.PROFILER.stage("replay"):
+                epd = line.end().board().epd()
         else:
             if line.startswith("#"):  # ignore comments
                 return line
@@ -73,18 +99,17 @@ class bulkpv:
         r = await (
             self.cdb.querypvstable(epd) if self.stable else self.cdb.querypv(epd)
         )
-        score = cdblib.json2eval(r)
-        if self.san:
-            ply = len(list(line.mainline_moves()))
-            pv = cdblib.json2pv(r, san=True, ply=ply)
-            return f"{line.mainline_moves()} ; cdb eval: {score}; PV: {pv};"
-        else:
-            pv = cdblib.json2pv(r)
-            if self.isPGN:
-                line = epd
-            return (
-                f"{line}{' ;' if line[-1] != ';' else ''} cdb eval: {score}; PV: {pv};"
-            )
+        with cdblib.PROFILER.stage("format"):
+            score = cdblib.json2eval(r)
+            if self.san:
+                ply = len(list(line.mainline_moves()))
+                pv = cdblib.json2pv(r, san=True, ply=ply)
+                return f"{line.mainline_moves()} ; cdb eval: {score}; PV: {pv};"
+            else:
+                pv = cdblib.json2pv(r)
+                if self.isPGN:
+                    line = epd
+                return f"{line}{' ;' if line[-1] != ';' else ''} cdb eval: {score}; PV: {pv};"
 
 
 async def main():
@@ -110,6 +135,22 @@ async def main():
         type=int,
         default=16,
     )
+    parser.add_argument(
+        "--hedgeFraction",
+        help="Maximal fraction of read-only requests that may be duplicated if they are slower than usual, to cut tail latency. Duplicates only use idle connections and rate limit tokens, but each one is an extra request to cdb.",
+        type=float,
+        default=0,
+    )
+    parser.add_argument(
+        "--cache",
+        help="Filename of a persistent SQLite cache for cdb's replies, which may be shared between runs and scripts. Only read-only requests are answered from it, so it gives hits only with --stable.",
+        default=None,
+    )
+    parser.add_argument(
+        "--prefillPVs",
+        action="store_true",
+        help="Use the PVs in cdb's replies to also answer stable PV requests for the positions along these PVs.",
+    )
     parser.add_argument(
         "-b",
         "--batchSize",
@@ -133,7 +174,13 @@ async def main():
         action="store_true",
         help="Run the script in an infinite loop.",
     )
+    parser.add_argument(
+        "--profile",
+        help="Write a profile of the run to this file: the time spent in the local stages and waiting for cdb, a CPU profile and the peak memory.",
+        default=None,
+    )
     args = parser.parse_args()
+    cdblib.PROFILER.start(args.profile)
     bpv = bulkpv(
         args.filename,
         args.stable,
@@ -141,6 +188,9 @@ async def main():
         args.concurrency,
         args.user,
         args.suppressErrors,
+        args.hedgeFraction,
+        args.cache,
+        args.prefillPVs,
     )
     while True:  # if args.forever is true, run indefinitely; o/w stop after one run
         # re-reading the data in each loop allows updates to it in the background
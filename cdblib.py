@@ -3,9 +3,30 @@
    Heavily based on Joost VandeVondele's https://github.com/vondele/cdbexplore
    See API documentation at https://www.chessdb.cn/cloudbookc_api_en.html
 """
-import asyncio, concurrent.futures, gzip, requests, sys, time, threading
+import array, asyncio, atexit, collections, concurrent.futures, cProfile, gzip, heapq
+import io
+import json, os, pstats, random
+import requests, signal, sqlite3, ssl, sys, tempfile, threading, time, urllib.parse
+import uuid, weakref
+import chess, chess.polyglot
+from contextlib import nullcontext
 from datetime import datetime
 
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+try:  # a faster json decoder, if available
+    from orjson import loads as json_loads
+except ImportError:
+    json_loads = json.loads
+
 
 class AtomicInteger:
     def __init__(self, value=0):
@@ -44,76 +65,2346 @@ class AtomicDict:
             self._cache[key] = value
 
 
-class cdbAPI:
-    def __init__(self, concurrency, user=None, showErrors=True):
+class LRUCache:
+    """dictionary with at most maxEntries entries, evicting the least recently used
+
+    Entries that are set as protected, e.g. positions close to the root that
+    are likely to be needed again, get a second chance: the first time they
+    are due for eviction they are moved back to the front of the queue.
+    The cache is meant for use within a single event loop, with lock=True it
+    can also be shared between threads.
+    """
+
+    def __init__(self, maxEntries, lock=False):
+        self.maxEntries = maxEntries
+        self._cache = collections.OrderedDict()  # key -> [value, protected]
+        self._lock = threading.Lock() if lock else nullcontext()
+        self.hits = self.misses = self.evictions = 0
+
+    def __len__(self):
+        return len(self._cache)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._cache.move_to_end(key)
+            return entry[0]
+
+    def set(self, key, value, protected=False):
+        with self._lock:
+            self._cache[key] = [value, protected]
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.maxEntries:
+                key, entry = self._cache.popitem(last=False)
+                if entry[1]:
+                    entry[1] = False  # spare it once
+                    self._cache[key] = entry
+                else:
+                    self.evictions += 1
+
+
+ZOBRIST_HASHER = chess.polyglot.ZobristHasher(chess.polyglot.POLYGLOT_RANDOM_ARRAY)
+
+
+class ZobristBoard(chess.Board):
+    """chess.Board that keeps a 64-bit key of its position up to date
+
+    The key is the polyglot Zobrist hash, which like cdb ignores the move
+    counters, and equals chess.polyglot.zobrist_hash(board) at all times. It
+    is updated incrementally in push() and pop() from the changed bitboards,
+    and recomputed from scratch after any other change to the board.
+    """
+
+    def __init__(self, *args, **kwargs):
+        # the key, the state it belongs to and the castling part of the key
+        self._zobrist, self._zobristState, self._zobristStack = (0, None, 0), None, []
+        super().__init__(*args, **kwargs)
+
+    def __state(self):
+        return (
+            self.pawns,
+            self.knights,
+            self.bishops,
+            self.rooks,
+            self.queens,
+            self.kings,
+            self.occupied_co[chess.BLACK],
+            self.occupied_co[chess.WHITE],
+            self.castling_rights,
+            self.ep_square,
+            self.turn,
+        )
+
+    @property
+    def zobrist(self):
+        state = self.__state()
+        if state != self._zobrist[1]:
+            castling = ZOBRIST_HASHER.hash_castling(self)
+            self._zobrist = (ZOBRIST_HASHER(self), state, castling)
+        return self._zobrist[0]
+
+    def push(self, move):
+        self.zobrist  # make sure that the key is up to date
+        key, before, castling = self._zobrist
+        self._zobristStack.append(self._zobrist)
+        if before[9] is not None:
+            key ^= ZOBRIST_HASHER.hash_ep_square(self)
+        super().push(move)
+        after = self.__state()
+        array = chess.polyglot.POLYGLOT_RANDOM_ARRAY
+        for i in range(6):
+            if before[i] == after[i] and before[7] & after[i] == after[7] & after[i]:
+                continue  # no change for this piece type
+            for color in (chess.BLACK, chess.WHITE):
+                diff = (before[i] & before[6 + color]) ^ (after[i] & after[6 + color])
+                for square in chess.scan_forward(diff):
+                    key ^= array[64 * (2 * i + color) + square]
+        if after[8] != before[8]:
+            key ^= castling
+            castling = ZOBRIST_HASHER.hash_castling(self)
+            key ^= castling
+        if after[9] is not None:
+            key ^= ZOBRIST_HASHER.hash_ep_square(self)
+        self._zobrist = (key ^ array[780], after, castling)
+
+    def pop(self):
+        move = super().pop()
+        if self._zobristStack:
+            self._zobrist = self._zobristStack.pop()
+        return move
+
+
+class PositionKeySet:
+    """set of 64-bit position keys, e.g. ZobristBoard.zobrist
+
+    The keys are stored in an open addressing hash table within an array,
+    which is kept between one and two thirds full. This costs 12-24 bytes per
+    key, and up to 1.5 times that while the table grows, instead of the 100+
+    bytes for an EPD string.
+    As the keys are hashes, distinct positions collide with a probability of
+    about n^2/2^65 for n keys.
+    """
+
+    def __init__(self, capacity=1024):
+        size = 1 << max(capacity * 3 // 2, 8).bit_length()
+        self._keys = array.array("Q", [0]) * size  # 0 marks an empty slot
+        self._mask = size - 1
+        self._len = 0
+        self._zero = False  # the key 0 itself is tracked separately
+
+    def __len__(self):
+        return self._len
+
+    def _slot(self, key):
+        # returns the index of key in self._keys, or of the empty slot for it
+        keys, mask = self._keys, self._mask
+        i = key & mask
+        while keys[i] and keys[i] != key:
+            i = (i + 1) & mask
+        return i
+
+    def __contains__(self, key):
+        if key == 0:
+            return self._zero
+        return self._keys[self._slot(key)] == key
+
+    def add(self, key):
+        # adds key, and returns True if it was not in the set before
+        if key == 0:
+            new, self._zero = not self._zero, True
+            self._len += new
+            return new
+        i = self._slot(key)
+        if self._keys[i]:
+            return False
+        self._keys[i] = key
+        self._len += 1
+        if 3 * self._len > 2 * len(self._keys):
+            self._grow()
+        return True
+
+    def _grow(self):
+        old = self._keys
+        self._keys = array.array("Q", [0]) * (2 * len(old))
+        self._mask = len(self._keys) - 1
+        for key in old:
+            if key:
+                self._keys[self._slot(key)] = key
+
+    def __iter__(self):
+        if self._zero:
+            yield 0
+        yield from (key for key in self._keys if key)
+
+
+class PositionKeyMap(PositionKeySet):
+    """map from 64-bit position keys to 64-bit signed integers, e.g. evals
+
+    The values are stored in a second array, which doubles the memory per key
+    compared to PositionKeySet.
+    """
+
+    def __init__(self, capacity=1024):
+        super().__init__(capacity)
+        self._values = array.array("q", [0]) * len(self._keys)
+        self._zeroValue = 0
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def get(self, key, default=None):
+        if key == 0:
+            return self._zeroValue if self._zero else default
+        i = self._slot(key)
+        return self._values[i] if self._keys[i] == key else default
+
+    def __setitem__(self, key, value):
+        if key == 0:
+            self._zeroValue = value
+        else:
+            self._values[self._slot(key)] = value
+        self.add(key)
+
+    def _grow(self):
+        old, values = self._keys, self._values
+        self._keys = array.array("Q", [0]) * (2 * len(old))
+        self._values = array.array("q", [0]) * (2 * len(old))
+        self._mask = len(self._keys) - 1
+        for key, value in zip(old, values):
+            if key:
+                i = self._slot(key)
+                self._keys[i], self._values[i] = key, value
+
+
+# priority classes for requests, see AdaptiveLimiter
+PRIORITY_INTERACTIVE, PRIORITY_NORMAL, PRIORITY_BACKGROUND = 0, 1, 2
+
+
+class AdaptiveLimiter:
+    """limits the number of concurrent requests, like an asyncio.Semaphore
+
+    If adaptive, the limit grows additively with every healthy reply and is cut
+    multiplicatively on congestion (rate limiting or timeouts), within the
+    bounds [minLimit, maxLimit] (AIMD). Congestion signals from requests that
+    were started before the last cut are ignored, so that a burst of failures
+    only reduces the limit once.
+
+    Waiting requests are served by weighted fair queuing over the priority
+    classes: with the default weights an interactive request gets 16 slots for
+    every slot of a background request, but no class is starved completely.
+    """
+
+    def __init__(
+        self, limit, minLimit=None, maxLimit=None, decrease=0.5, weights=(16, 4, 1)
+    ):
+        self.adaptive = minLimit is not None or maxLimit is not None
+        if minLimit is None:
+            minLimit = 1 if self.adaptive else limit
+        self.minLimit = max(1, int(minLimit))
+        self.maxLimit = max(self.minLimit, int(limit if maxLimit is None else maxLimit))
+        self._limit = float(min(max(limit, self.minLimit), self.maxLimit))
+        self.decrease = decrease
+        self.lastDecrease = 0.0
+        self.inflight = 0
+        self.weights = weights
+        self._waiters = [collections.deque() for _ in weights]
+        self._pass = [0.0 for _ in weights]  # virtual finish times per class
+        self._vtime = 0.0
+        self.waiting = 0
+
+    @property
+    def limit(self):
+        return int(self._limit)
+
+    async def acquire(self, priority=PRIORITY_NORMAL):
+        if self.inflight < self.limit and not self.waiting:
+            self.inflight += 1
+            return time.monotonic()
+        future = asyncio.get_running_loop().create_future()
+        if not self._waiters[priority]:
+            # an idle class must not bank credit from the time it was idle
+            self._pass[priority] = max(self._pass[priority], self._vtime)
+        self._waiters[priority].append(future)
+        self.waiting += 1
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release()  # the slot was handed over already, pass it on
+            elif future in self._waiters[priority]:
+                self._waiters[priority].remove(future)
+                self.waiting -= 1
+            raise
+        return time.monotonic()
+
+    def try_acquire(self):
+        # takes a free slot if there is one, without waiting
+        if self.inflight < self.limit and not self.waiting:
+            self.inflight += 1
+            return True
+        return False
+
+    def release(self):
+        self.inflight -= 1
+        self.__wake()
+
+    def __wake(self):
+        while self.waiting and self.inflight < self.limit:
+            # serve the non-empty class with the smallest virtual time
+            p = min(
+                (p for p, q in enumerate(self._waiters) if q),
+                key=lambda p: self._pass[p],
+            )
+            future = self._waiters[p].popleft()
+            self.waiting -= 1
+            self._vtime = self._pass[p]
+            self._pass[p] += 1 / self.weights[p]
+            if not future.done():
+                self.inflight += 1
+                future.set_result(None)
+
+    def success(self):
+        if self.adaptive and self._limit < self.maxLimit:
+            self._limit = min(self._limit + 1 / self._limit, self.maxLimit)
+            self.__wake()
+
+    def congestion(self, started):
+        # started is the value returned by acquire() for the failed request
+        if self.adaptive and started >= self.lastDecrease:
+            self._limit = max(self._limit * self.decrease, self.minLimit)
+            self.lastDecrease = time.monotonic()
+
+
+class SharedRateLimiter:
+    """token bucket rate limiter, shared by all processes on the host
+
+    All processes that use the same state file split the budget of rate
+    requests per second among themselves, in proportion to their weights.
+    Processes that have not made a request within the last expiry seconds,
+    or that no longer exist, drop out of the split. Next to the token of each
+    process, the state file holds a common bucket that is refilled at rate,
+    so that the processes together stay within the budget even while the
+    split changes. Neither bucket holds more than one token, i.e. there are
+    no bursts. The state file is guarded
+    with an exclusive lock, which is taken without blocking the event loop.
+    Without fcntl (e.g. on Windows) the limiter only applies to the current
+    process. Within a process, the tokens go to the waiting requests in the
+    order of their priority, and of their arrival within a priority.
+    """
+
+    LOCK_RETRY = 0.002  # seconds between attempts to take a busy lock
+
+    def __init__(self, rate, filename=None, weight=1, expiry=10):
+        self.rate = float(rate)
+        self.weight = float(weight)
+        self.expiry = expiry
+        if filename is None:
+            filename = os.path.join(tempfile.gettempdir(), "cdblib_ratelimit.json")
+        self.filename = filename
+        self.key = f"{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._state = {}  # only used without fcntl
+        self._waiters = []  # heap of (priority, arrival, future)
+        self._arrivals = 0
+
+    def __update(self, state, now):
+        # refills and possibly takes one token, returns the wait time if empty
+        if "procs" not in state:
+            state.clear()  # new, or written by an older version
+        procs = state.setdefault("procs", {})
+        for key in list(procs):
+            if key == self.key:
+                continue
+            if now - procs[key]["seen"] > self.expiry or not _pid_alive(key):
+                del procs[key]
+        me = procs.setdefault(self.key, {"tokens": 1.0, "t": now})
+        me["weight"], me["seen"] = self.weight, now
+        share = self.rate * self.weight / sum(p["weight"] for p in procs.values())
+        me["tokens"] = min(1.0, me["tokens"] + share * max(now - me["t"], 0))
+        me["t"] = now
+        common = state.setdefault("common", {"tokens": 1.0, "t": now})
+        common["tokens"] = min(
+            1.0, common["tokens"] + self.rate * max(now - common["t"], 0)
+        )
+        common["t"] = now
+        if me["tokens"] >= 1 and common["tokens"] >= 1:
+            me["tokens"] -= 1
+            common["tokens"] -= 1
+            return 0
+        return max((1 - me["tokens"]) / share, (1 - common["tokens"]) / self.rate)
+
+    def __take(self):
+        # returns the wait time, or None if another process holds the lock
+        now = time.time()
+        if fcntl is None:
+            return self.__update(self._state, now)
+        with open(self.filename, "a+") as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return None
+            f.seek(0)
+            try:
+                state = json.loads(f.read() or "{}")
+            except ValueError:
+                state = {}  # e.g. a crash during a write, simply start afresh
+            wait = self.__update(state, now)
+            f.seek(0)
+            f.truncate()
+            f.write(json.dumps(state))
+            f.flush()
+            return wait  # closing the file releases the lock
+
+    def try_acquire(self):
+        # takes a token if one is available right away, e.g. for a hedge
+        return not self._waiters and self.__take() == 0
+
+    async def acquire(self, priority=PRIORITY_NORMAL):
+        # only the first waiter in the heap polls for a token, the others wait
+        # for their turn
+        turn = asyncio.get_running_loop().create_future()
+        entry = (priority, self._arrivals, turn)
+        self._arrivals += 1
+        heapq.heappush(self._waiters, entry)
+        try:
+            if self._waiters[0] is not entry:
+                await turn
+            while (wait := self.__take()) != 0:
+                await asyncio.sleep(self.LOCK_RETRY if wait is None else wait)
+        finally:
+            self._waiters.remove(entry)
+            heapq.heapify(self._waiters)
+            if self._waiters and not self._waiters[0][2].done():
+                self._waiters[0][2].set_result(None)
+
+
+def _pid_alive(key):
+    # key is of the form "pid:nonce", see SharedRateLimiter
+    try:
+        os.kill(int(key.split(":")[0]), 0)
+    except ProcessLookupError:
+        return False
+    except (PermissionError, ValueError):
+        pass
+    return True
+
+
+class LatencyTracker:
+    """keeps the latencies of the most recent successful requests"""
+
+    def __init__(self, size=256):
+        self.samples = collections.deque(maxlen=size)
+        self._sorted = None
+
+    def __len__(self):
+        return len(self.samples)
+
+    def add(self, seconds):
+        self.samples.append(seconds)
+        self._sorted = None
+
+    def percentile(self, p):
+        # returns the p-th percentile of the stored latencies, or None
+        if not self.samples:
+            return None
+        if self._sorted is None:
+            self._sorted = sorted(self.samples)
+        n = len(self._sorted)
+        return self._sorted[min(int(n * p / 100), n - 1)]
+
+
+class RetryBudgetExceeded(Exception):
+    """raised by cdbAPI.generic_call if the retry policy gives up"""
+
+
+class RetryPolicy:
+    """timeouts and back-off between the attempts of cdbAPI.generic_call
+
+    The HTTP timeout is derived from the observed latencies, and grows with
+    every further attempt. The sleep between attempts is independent of the
+    timeout, depends on the reason for the retry, and uses decorrelated
+    jitter, so that retries from many co-routines do not line up. The default
+    budget of attempts and time is unlimited.
+    """
+
+    # the reasons for a retry
+    NETWORK, RATELIMIT, MALFORMED = "network", "rate limit", "malformed"
+    TIMEOUT = "timeout"
+
+    def __init__(
+        self,
+        backoff=None,
+        maxAttempts=None,
+        maxTime=None,
+        minTimeout=2,
+        maxTimeout=60,
+        initialTimeout=5,
+        timeoutFactor=3,
+        percentile=99,
+        warnAfter=6,
+    ):
+        # backoff maps the reasons to (base, cap) of the sleep in seconds
+        self.backoff = {
+            self.NETWORK: (1, 60),
+            self.TIMEOUT: (1, 60),
+            self.RATELIMIT: (5, 120),
+            self.MALFORMED: (1, 30),
+        }
+        if backoff:
+            self.backoff.update(backoff)
+        self.maxAttempts = maxAttempts
+        self.maxTime = maxTime
+        self.minTimeout = minTimeout
+        self.maxTimeout = maxTimeout
+        self.initialTimeout = initialTimeout
+        self.timeoutFactor = timeoutFactor
+        self.percentile = percentile
+        self.warnAfter = warnAfter  # attempts after which failures are shown
+        self.latency = LatencyTracker()
+
+    def timeout(self, attempt):
+        # the HTTP timeout for the given attempt, counting from 0
+        timeout = self.initialTimeout
+        if len(self.latency) >= 20:
+            timeout = self.timeoutFactor * self.latency.percentile(self.percentile)
+        timeout = max(timeout, self.minTimeout) * 1.5**attempt
+        return min(timeout, self.maxTimeout)
+
+    def delay(self, reason, previous):
+        # the sleep before the next attempt, given the previous sleep
+        base, cap = self.backoff[reason]
+        return min(cap, random.uniform(base, 3 * max(base, previous)))
+
+    def exhausted(self, attempts, elapsed):
+        return (self.maxAttempts is not None and attempts >= self.maxAttempts) or (
+            self.maxTime is not None and elapsed >= self.maxTime
+        )
+
+
+class FailedAttempt:
+    """the result of an attempt that did not give a json reply
+
+    kind is "network", "timeout" or "invalid json". Only the latter means
+    that the server did answer, so it is neither congestion nor an outage.
+    """
+
+    __slots__ = ("kind",)
+
+    def __init__(self, kind):
+        self.kind = kind
+
+    @property
+    def answered(self):
+        return self.kind == "invalid json"
+
+
+class CircuitBreaker:
+    """pauses all the traffic to the API during server outages
+
+    After threshold consecutive failed requests (network errors, timeouts) the
+    breaker opens: all requests wait, and every probeInterval seconds a single
+    probe request is let through. Once a probe succeeds, the breaker is
+    half-open, and requests are let through with a probability that grows
+    linearly over rampTime seconds. A few consecutive failures in this phase
+    reopen the breaker, o/w it closes again after rampTime seconds.
+    """
+
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half-open"
+
+    def __init__(self, threshold=20, probeInterval=5, rampTime=30, showErrors=False):
+        self.threshold = threshold
+        self.probeInterval = probeInterval
+        self.rampTime = rampTime
+        self.showErrors = showErrors
+        self.state = self.CLOSED
+        self.since = time.monotonic()
+        self.stateTime = {self.CLOSED: 0.0, self.OPEN: 0.0, self.HALF_OPEN: 0.0}
+        self.failures = 0
+        self.probeAllowed = False
+        self._waiters = collections.deque()
+
+    def times(self):
+        # returns the total time spent in each state so far
+        times = dict(self.stateTime)
+        times[self.state] += time.monotonic() - self.since
+        return times
+
+    def __set_state(self, state):
+        now = time.monotonic()
+        self.stateTime[self.state] += now - self.since
+        self.state, self.since = state, now
+        self.failures = 0
+        if self.showErrors:
+            print(
+                datetime.now().isoformat(),
+                f" - circuit breaker is now {state}",
+                file=sys.stderr,
+                flush=True,
+            )
+        if state == self.OPEN:
+            self.probeAllowed = False
+            asyncio.get_running_loop().call_later(
+                self.probeInterval, self.__allow_probe
+            )
+        else:
+            while self._waiters:
+                future = self._waiters.popleft()
+                if not future.done():
+                    future.set_result(False)
+
+    def __allow_probe(self):
+        if self.state != self.OPEN:
+            return
+        while self._waiters:
+            future = self._waiters.popleft()
+            if not future.done():
+                future.set_result(True)
+                return
+        self.probeAllowed = True  # the next request will be the probe
+
+    async def admit(self):
+        # waits until a request may be sent, returns True for a probe request
+        while self.state != self.CLOSED:
+            if self.state == self.OPEN:
+                if self.probeAllowed:
+                    self.probeAllowed = False
+                    return True
+                future = asyncio.get_running_loop().create_future()
+                self._waiters.append(future)
+                try:
+                    if await future:
+                        return True
+                except asyncio.CancelledError:
+                    if future.done() and future.result():
+                        self.__allow_probe()  # pass the probe on
+                    raise
+            else:
+                ramp = (time.monotonic() - self.since) / self.rampTime
+                if random.random() < ramp:
+                    return False
+                await asyncio.sleep(random.uniform(0, self.rampTime / 10))
+        return False
+
+    def record(self, success, probe=False):
+        if success:
+            if self.state == self.OPEN:
+                self.__set_state(self.HALF_OPEN)
+            elif self.state == self.HALF_OPEN:
+                if time.monotonic() - self.since >= self.rampTime:
+                    self.__set_state(self.CLOSED)
+            self.failures = 0
+        elif self.state == self.OPEN:
+            if probe:
+                asyncio.get_running_loop().call_later(
+                    self.probeInterval, self.__allow_probe
+                )
+        else:
+            self.failures += 1
+            limit = self.threshold if self.state == self.CLOSED else 3
+            if self.failures >= limit:
+                self.__set_state(self.OPEN)
+
+
+CDB_URL = "http://www.chessdb.cn/cdb.php"
+
+
+class EndpointRouter:
+    """chooses among several URLs of the API, e.g. mirrors or a local server
+
+    Every request goes to the healthy endpoint with the lowest expected time
+    per successful reply, i.e. its (exponentially weighted) average latency
+    divided by its recent success rate, where endpoints without a measurement
+    yet come first. A fraction explore of the requests goes to another
+    healthy endpoint at random, so that the estimates of the slower endpoints
+    stay up to date. After maxFailures consecutive failures an endpoint is
+    taken out of the rotation for a cooldown that doubles with every further
+    failure.
+    """
+
+    def __init__(
+        self,
+        urls,
+        maxFailures=3,
+        cooldown=5,
+        maxCooldown=120,
+        alpha=0.2,
+        explore=0.05,
+    ):
+        self.urls = list(urls)
+        self.explore = explore
+        self.maxFailures = maxFailures
+        self.cooldown = cooldown
+        self.maxCooldown = maxCooldown
+        self.alpha = alpha
+        self.latency = {url: None for url in self.urls}
+        self.errorRate = {url: 0.0 for url in self.urls}
+        self.failures = {url: 0 for url in self.urls}
+        self.downUntil = {url: 0.0 for url in self.urls}
+
+    def pick(self, exclude=None):
+        # exclude is avoided if another healthy endpoint exists, e.g. for hedging
+        now = time.monotonic()
+        healthy = [url for url in self.urls if self.downUntil[url] <= now]
+        if len(healthy) > 1 and exclude in healthy:
+            healthy.remove(exclude)
+        if not healthy:  # all are down, try the one that recovers first
+            return min(self.urls, key=lambda url: self.downUntil[url])
+        best = min(healthy, key=self.__cost)
+        if len(healthy) > 1 and random.random() < self.explore:
+            return random.choice([url for url in healthy if url != best])
+        return best
+
+    def __cost(self, url):
+        # the expected time per successful reply, if every failure is retried
+        latency = self.latency[url]
+        if latency is None:
+            return 0
+        return latency / max(1 - self.errorRate[url], 0.05)
+
+    def record(self, url, success, latency=None):
+        a = self.alpha
+        self.errorRate[url] = (1 - a) * self.errorRate[url] + a * (not success)
+        if success:
+            self.failures[url] = 0
+            old = self.latency[url]
+            self.latency[url] = latency if old is None else (1 - a) * old + a * latency
+            return
+        self.failures[url] += 1
+        excess = self.failures[url] - self.maxFailures
+        if excess >= 0:
+            cooldown = min(self.cooldown * 2**excess, self.maxCooldown)
+            self.downUntil[url] = time.monotonic() + cooldown
+
+    def stats(self):
+        # returns a dict url -> (average latency, error rate, healthy)
+        now = time.monotonic()
+        return {
+            url: (self.latency[url], self.errorRate[url], self.downUntil[url] <= now)
+            for url in self.urls
+        }
+
+
+def default_endpoints():
+    # the environment variable CDBLIB_ENDPOINTS may hold a comma separated list
+    # of URLs, e.g. to point all the scripts to a mirror or a local server
+    urls = os.environ.get("CDBLIB_ENDPOINTS", "").replace(",", " ").split()
+    return urls if urls else [CDB_URL]
+
+
+def query_action(query):
+    # the action of a query string of the API, e.g. "?action=queryall&board=..."
+    return query.partition("action=")[2].partition("&")[0]
+
+
+def is_read_only(action, optionString=""):
+    # True for requests that do not trigger learning on cdb, and may be repeated
+    if action == "queryall":
+        return True
+    if action == "queryscore":
+        return "learn=0" in optionString
+    if action == "querypv":
+        return "stable=1" in optionString
+    return False
+
+
+class RequestsTransport:
+    """blocking HTTP transport: a requests.Session driven from a thread pool"""
+
+    def __init__(self, concurrency, userAgent, poolSize=None):
         # use a session to keep alive the connection to the server
         self.session = requests.Session()
-        self.user = "" if user is None else str(user)
-        self.showErrors = showErrors
-        # a semaphore to limit the number of concurrent accesses to the API
-        self.semaphoreAPI = asyncio.Semaphore(concurrency)
+        self.session.headers.update({"user-agent": userAgent})
+        # the default adapter only keeps 10 connections alive
+        poolSize = concurrency if poolSize is None else poolSize
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=4, pool_maxsize=max(poolSize, 1)
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
         # a thread pool to do some of the blocking IO
         self.executorWork = concurrent.futures.ThreadPoolExecutor(
             max_workers=concurrency
         )
 
-    def __apicall(self, url, timeout):
+    def __get(self, url, timeout, timing, submitted):
+        if timing is not None:
+            timing["executor"] = time.monotonic() - submitted
+        response = self.session.get(url, timeout=timeout)
+        response.raise_for_status()
+        return response.content
+
+    async def get(self, url, timeout, timing=None):
+        # returns the body of the reply as bytes, raises on any error
+        # timing may be a dict, that gets the time spent waiting for a thread
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executorWork, self.__get, url, timeout, timing, time.monotonic()
+        )
+
+    async def warmup(self, url, n, timeout=15):
+        # open n keep-alive connections with simultaneous HEAD requests
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(
+            *(
+                loop.run_in_executor(
+                    self.executorWork,
+                    lambda: self.session.head(url, timeout=timeout).close(),
+                )
+                for _ in range(n)
+            ),
+            return_exceptions=True,
+        )
+
+
+class AsyncioTransport:
+    """non-blocking HTTP/1.1 transport on top of asyncio streams
+
+    Connections are kept alive and handed back to a pool of idle connections
+    after each complete reply, so that consecutive requests to the same host
+    reuse the same TCP (and TLS) connection.
+    """
+
+    def __init__(self, concurrency, userAgent, poolSize=None):
+        self.userAgent = userAgent
+        self.poolSize = concurrency if poolSize is None else poolSize
+        self._idle = {}  # (scheme, host, port) -> list of (reader, writer)
+        self._sslContext = None
+
+    def __ssl(self, scheme):
+        if scheme != "https":
+            return None
+        if self._sslContext is None:
+            self._sslContext = ssl.create_default_context()
+        return self._sslContext
+
+    async def __connect(self, key):
+        # returns an idle connection from the pool if possible, o/w a new one
+        idle = self._idle.get(key)
+        while idle:
+            reader, writer = idle.pop()
+            if not writer.is_closing() and not reader.at_eof():
+                return reader, writer, True
+            writer.close()
+        scheme, host, port = key
+        reader, writer = await asyncio.open_connection(
+            host, port, ssl=self.__ssl(scheme)
+        )
+        return reader, writer, False
+
+    def __release(self, key, reader, writer):
+        idle = self._idle.setdefault(key, [])
+        if len(idle) < self.poolSize and not writer.is_closing():
+            idle.append((reader, writer))
+        else:
+            writer.close()
+
+    @staticmethod
+    async def __read_reply(reader):
+        # returns (status code, body, keepAlive) of a HTTP/1.1 reply
+        line = await reader.readuntil(b"\r\n")
+        version, status, _ = line.decode("latin-1").split(" ", 2)
+        headers = {}
+        while (line := await reader.readuntil(b"\r\n")) != b"\r\n":
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            chunks = []
+            while size := int((await reader.readuntil(b"\r\n")).split(b";")[0], 16):
+                chunks.append(await reader.readexactly(size))
+                await reader.readuntil(b"\r\n")
+            while await reader.readuntil(b"\r\n") != b"\r\n":
+                pass  # ignore trailers
+            body = b"".join(chunks)
+        elif "content-length" in headers:
+            body = await reader.readexactly(int(headers["content-length"]))
+        else:
+            body = await reader.read()
+            headers["connection"] = "close"
+        if headers.get("content-encoding", "").lower() == "gzip":
+            body = gzip.decompress(body)
+        connection = headers.get("connection", "").lower()
+        keepAlive = connection != "close" and (
+            version != "HTTP/1.0" or connection == "keep-alive"
+        )
+        return int(status), body, keepAlive
+
+    async def __get(self, url):
+        parts = urllib.parse.urlsplit(url)
+        port = parts.port or (443 if parts.scheme == "https" else 80)
+        key = (parts.scheme, parts.hostname, port)
+        target = (parts.path or "/") + (f"?{parts.query}" if parts.query else "")
+        target = urllib.parse.quote(target, safe="!#$%&'()*+,/:;=?@[]~")
+        request = (
+            f"GET {target} HTTP/1.1\r\n"
+            f"Host: {parts.netloc}\r\n"
+            f"User-Agent: {self.userAgent}\r\n"
+            "Accept: application/json\r\n"
+            "Accept-Encoding: gzip\r\n"
+            "Connection: keep-alive\r\n\r\n"
+        ).encode("latin-1")
+        while True:
+            reader, writer, reused = await self.__connect(key)
+            try:
+                writer.write(request)
+                await writer.drain()
+                status, body, keepAlive = await self.__read_reply(reader)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                writer.close()
+                if reused:
+                    continue  # server closed the idle connection, use a new one
+                raise
+            except BaseException:
+                # e.g. a timeout: the connection is in an unknown state
+                writer.close()
+                raise
+            if keepAlive:
+                self.__release(key, reader, writer)
+            else:
+                writer.close()
+            if status >= 400:
+                raise ConnectionError(f"HTTP status {status} for {url}")
+            return body
+
+    async def get(self, url, timeout, timing=None):
+        # returns the body of the reply as bytes, raises on any error
+        return await asyncio.wait_for(self.__get(url), timeout)
+
+    async def __open(self, key):
+        scheme, host, port = key
+        reader, writer = await asyncio.open_connection(
+            host, port, ssl=self.__ssl(scheme)
+        )
+        self.__release(key, reader, writer)
+
+    async def warmup(self, url, n, timeout=15):
+        # open n keep-alive connections and add them to the idle pool
+        parts = urllib.parse.urlsplit(url)
+        port = parts.port or (443 if parts.scheme == "https" else 80)
+        key = (parts.scheme, parts.hostname, port)
+        n = min(n, self.poolSize) - len(self._idle.get(key, []))
+        await asyncio.gather(
+            *(asyncio.wait_for(self.__open(key), timeout) for _ in range(n)),
+            return_exceptions=True,
+        )
+
+
+TRANSPORTS = {"requests": RequestsTransport, "asyncio": AsyncioTransport}
+
+
+class CassetteMissError(Exception):
+    """a request that is not on the cassette being replayed"""
+
+
+class OfflineError(Exception):
+    """a request that cannot be answered without access to cdb"""
+
+
+class RecordingTransport:
+    """wraps a transport and records all its requests to a cassette
+
+    A cassette is a gzipped file with one json line per request, holding the
+    query string, the latency and either the body of the reply or the error.
+    Transports in the same process that record to the same file share it.
+    """
+
+    _files = {}  # filename -> [file object, start time]
+
+    def __init__(self, transport, filename):
+        self.transport = transport
+        self.filename = filename
+        if filename not in self._files:
+            self._files[filename] = [gzip.open(filename, "wt"), time.monotonic()]
+            atexit.register(self._files[filename][0].close)
+
+    def __write(self, record):
+        f, start = self._files[self.filename]
+        record["t"] = round(time.monotonic() - start - record["latency"], 4)
+        f.write(json.dumps(record) + "\n")
+
+    async def get(self, url, timeout, timing=None):
+        query = urllib.parse.urlsplit(url).query
+        tic = time.monotonic()
         try:
-            response = self.session.get(
-                url,
-                timeout=timeout,
-                headers={"user-agent": "cdblib" + bool(self.user) * "/" + self.user},
-            )
-            response.raise_for_status()
-            content = response.json()
-        except Exception:
+            body = await self.transport.get(url, timeout, timing)
+        except (Exception, asyncio.CancelledError) as e:
+            latency = round(time.monotonic() - tic, 4)
+            error = "timeout" if isinstance(e, asyncio.TimeoutError) else "error"
+            if isinstance(e, asyncio.CancelledError):
+                error = "cancelled"
+            self.__write({"query": query, "latency": latency, "error": error})
+            raise
+        latency = round(time.monotonic() - tic, 4)
+        self.__write({"query": query, "latency": latency, "body": body.decode("utf-8")})
+        return body
+
+    async def warmup(self, url, n):
+        await self.transport.warmup(url, n)
+
+
+class ReplayTransport:
+    """transport that replays the replies recorded on a cassette
+
+    Repeated requests get the recorded replies in the recorded order, the
+    last one being repeated once they are used up. latency is "recorded",
+    "zero" or a factor for the recorded latencies. Requests that are not
+    on the cassette raise CassetteMissError, which cdbAPI does not retry.
+    """
+
+    def __init__(self, filename, latency="recorded"):
+        self.scale = {"recorded": 1, "zero": 0}.get(latency)
+        if self.scale is None:
+            self.scale = float(latency)
+        self.records = {}  # query -> deque of records
+        with gzip.open(filename, "rt") as f:
+            for line in f:
+                record = json.loads(line)
+                if record.get("error") == "cancelled":
+                    continue  # e.g. the loser of a hedged request
+                self.records.setdefault(record["query"], collections.deque())
+                self.records[record["query"]].append(record)
+        self.misses = AtomicInteger()
+
+    async def get(self, url, timeout, timing=None):
+        query = urllib.parse.urlsplit(url).query
+        records = self.records.get(query)
+        if not records:
+            self.misses.inc()
+            raise CassetteMissError(f"No recorded reply for {query}")
+        record = records.popleft() if len(records) > 1 else records[0]
+        latency = record["latency"] * self.scale
+        if latency > timeout:
+            await asyncio.sleep(timeout)
+            raise asyncio.TimeoutError
+        if latency > 0:
+            await asyncio.sleep(latency)
+        if "error" in record:
+            if record["error"] == "timeout":
+                raise asyncio.TimeoutError
+            raise ConnectionError(f"Recorded error for {query}")
+        return record["body"].encode("utf-8")
+
+    async def warmup(self, url, n):
+        pass
+
+
+def cassette_transport(transport):
+    # the environment variables CDBLIB_RECORD and CDBLIB_REPLAY may name a
+    # cassette to record the traffic to, or to replay it from, in which case
+    # CDBLIB_REPLAY_LATENCY is "recorded" (default), "zero" or a factor
+    replay = os.environ.get("CDBLIB_REPLAY")
+    if replay:
+        return ReplayTransport(
+            replay, os.environ.get("CDBLIB_REPLAY_LATENCY", "recorded")
+        )
+    record = os.environ.get("CDBLIB_RECORD")
+    if record:
+        return RecordingTransport(transport, record)
+    return transport
+
+
+HTTP_REASONS = {
+    200: "OK",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    500: "Internal Server Error",
+    502: "Bad Gateway",
+}
+
+
+async def start_http_server(handler, host="127.0.0.1", port=0):
+    """starts a minimal HTTP/1.1 server for GET requests, with keep-alive
+
+    handler is a co-routine handler(target, headers) that is called with the
+    request target (path and query) and a dict of the (lower case) headers,
+    and returns a tuple (status code, content type, body as bytes), or None
+    to close the connection without a reply. Returns the asyncio.Server.
+    """
+
+    async def serve(reader, writer):
+        try:
+            while line := await reader.readline():
+                try:
+                    method, target, version = line.decode("latin-1").split()
+                except ValueError:
+                    break
+                headers = {}
+                while (line := await reader.readline()).strip():
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                if "content-length" in headers:
+                    await reader.readexactly(int(headers["content-length"]))
+                if method != "GET":
+                    status, contentType, body = 405, "text/plain", b"GET only\n"
+                else:
+                    try:
+                        reply = await handler(target, headers)
+                        if reply is None:
+                            break
+                        status, contentType, body = reply
+                    except Exception as e:
+                        status, contentType = 500, "text/plain"
+                        body = f"{type(e).__name__}: {e}\n".encode()
+                connection = headers.get("connection", "").lower()
+                keepAlive = connection != "close" and (
+                    version != "HTTP/1.0" or connection == "keep-alive"
+                )
+                writer.write(
+                    (
+                        f"HTTP/1.1 {status} {HTTP_REASONS.get(status, '')}\r\n"
+                        f"Content-Type: {contentType}\r\n"
+                        f"Content-Length: {len(body)}\r\n"
+                        f"Connection: {'keep-alive' if keepAlive else 'close'}\r\n"
+                        "\r\n"
+                    ).encode("latin-1")
+                    + body
+                )
+                await writer.drain()
+                if not keepAlive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass  # the client went away
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(serve, host, port)
+
+
+class Metrics:
+    """registry of counters, gauges and histograms, with labels
+
+    The values can be exported in the Prometheus text format, served on a
+    local port, or as json, e.g. dumped to a file at exit. Gauges may also be
+    given as functions, which are evaluated at export time.
+    """
+
+    BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self):
+        self.counters = collections.defaultdict(float)  # (name, labels) -> value
+        self.gauges = {}  # (name, labels) -> value or function
+        self.histograms = {}  # (name, labels) -> [bucket counts, sum, count]
+        self.help = {}
+        self.pages = {}  # further paths to serve: path -> function(params) -> text
+        self.server = self.serving = None
+
+    @staticmethod
+    def __key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        self.counters[self.__key(name, labels)] += value
+
+    def set(self, name, value, **labels):
+        # value may be a function without arguments, once it returns None the
+        # gauge is dropped
+        self.gauges[self.__key(name, labels)] = value
+
+    def observe(self, name, value, **labels):
+        key = self.__key(name, labels)
+        h = self.histograms.get(key)
+        if h is None:
+            h = self.histograms[key] = [[0] * len(self.BUCKETS), 0, 0]
+        for i, bound in enumerate(self.BUCKETS):
+            if value <= bound:
+                h[0][i] += 1
+        h[1] += value
+        h[2] += 1
+
+    def __gauges(self):
+        for key, value in list(self.gauges.items()):
+            if callable(value) and (value := value()) is None:
+                del self.gauges[key]
+                continue
+            yield key, value
+
+    @staticmethod
+    def __labels(labels, **extra):
+        labels = labels + tuple(extra.items())
+        if not labels:
+            return ""
+        return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+    def prometheus(self):
+        # returns the metrics in the Prometheus text exposition format
+        lines, typed = [], set()
+
+        def header(name, kind):
+            if name not in typed:
+                typed.add(name)
+                if name in self.help:
+                    lines.append(f"# HELP {name} {self.help[name]}")
+                lines.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), value in sorted(self.counters.items()):
+            header(name, "counter")
+            lines.append(f"{name}{self.__labels(labels)} {value:g}")
+        for (name, labels), value in sorted(self.__gauges()):
+            header(name, "gauge")
+            lines.append(f"{name}{self.__labels(labels)} {value:g}")
+        for (name, labels), (buckets, total, count) in sorted(self.histograms.items()):
+            header(name, "histogram")
+            for bound, n in zip(self.BUCKETS, buckets):
+                lines.append(f"{name}_bucket{self.__labels(labels, le=bound)} {n}")
+            lines.append(f'{name}_bucket{self.__labels(labels, le="+Inf")} {count}')
+            lines.append(f"{name}_sum{self.__labels(labels)} {total:g}")
+            lines.append(f"{name}_count{self.__labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+    def json(self):
+        # returns the metrics as a dict, with the labels as "k=v,k=v" strings
+        d = {"counters": {}, "gauges": {}, "histograms": {}}
+
+        def add(kind, name, labels, value):
+            labels = ",".join(f"{k}={v}" for k, v in labels)
+            d[kind].setdefault(name, {})[labels] = value
+
+        for (name, labels), value in self.counters.items():
+            add("counters", name, labels, value)
+        for (name, labels), value in self.__gauges():
+            add("gauges", name, labels, value)
+        for (name, labels), (buckets, total, count) in self.histograms.items():
+            h = {"buckets": dict(zip(map(str, self.BUCKETS), buckets))}
+            add("histograms", name, labels, dict(h, sum=total, count=count))
+        return d
+
+    def dump(self, filename):
+        with open(filename, "w") as f:
+            json.dump(self.json(), f, indent=1)
+
+    async def handle(self, target, headers):
+        # a handler for start_http_server
+        parts = urllib.parse.urlsplit(target)
+        if parts.path == "/metrics":
+            return 200, "text/plain; version=0.0.4", self.prometheus().encode()
+        if parts.path == "/metrics.json":
+            return 200, "application/json", json.dumps(self.json()).encode()
+        if parts.path in self.pages:
+            params = dict(urllib.parse.parse_qsl(parts.query))
+            return 200, "text/plain", self.pages[parts.path](params).encode()
+        paths = " or ".join(["/metrics", "/metrics.json"] + list(self.pages))
+        return 404, "text/plain", f"Try {paths}\n".encode()
+
+    async def serve(self, port, host="127.0.0.1"):
+        # serves /metrics (Prometheus) and /metrics.json on the given port
+        if self.server is None:
+            self.server = await start_http_server(self.handle, host, port)
+        return self.server
+
+    def start_from_env(self):
+        # the environment variable CDBLIB_METRICS_PORT may give a port to serve
+        # the metrics on, and CDBLIB_METRICS_FILE a file to dump them to at exit
+        filename = os.environ.get("CDBLIB_METRICS_FILE")
+        if filename and not getattr(self, "dumpAtExit", None):
+            self.dumpAtExit = filename
+            atexit.register(self.dump, filename)
+        port = os.environ.get("CDBLIB_METRICS_PORT")
+        if port and self.serving is None:
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                return  # no event loop yet: nothing can be served
+            self.serving = loop.create_task(self.serve(int(port)))
+
+
+# the registry that all cdbAPI objects report to by default
+METRICS = Metrics()
+METRICS.help.update(
+    {
+        "cdblib_calls_total": "API calls by action and by how they were answered",
+        "cdblib_requests_total": "requests sent to cdb, by action",
+        "cdblib_replies_total": "replies from cdb, by action and status",
+        "cdblib_retries_total": "retried requests, by reason",
+        "cdblib_errors_total": "failed requests, by kind",
+        "cdblib_received_bytes_total": "bytes received from cdb",
+        "cdblib_call_seconds": "time per request, including waiting for a slot",
+        "cdblib_request_seconds": "time per request to cdb",
+        "cdblib_inflight": "requests currently sent to cdb",
+        "cdblib_waiting": "requests currently waiting for a slot",
+        "cdblib_concurrency_limit": "current limit on concurrent requests",
+    }
+)
+
+
+class InflightRequest:
+    # the state of a request in cdbAPI.generic_call, see RequestInspector
+    __slots__ = ("action", "fen", "attempt", "state", "lastError", "started")
+    __slots__ += ("sent", "warned", "showErrors")
+
+    def __init__(self, action, fen, showErrors=False):
+        self.action, self.fen = action, fen
+        self.attempt, self.state, self.lastError = 0, "new", ""
+        self.started = time.monotonic()
+        self.sent = None  # once the first attempt holds a slot
+        self.warned = False
+        self.showErrors = showErrors  # of the cdbAPI that made the request
+
+    def __str__(self):
+        age = time.monotonic() - self.started
+        s = f"{self.action} {self.fen}: {age:.1f}s old, attempt {self.attempt}"
+        s += f" ({self.state})"
+        return s + (f", last error: {self.lastError}" if self.lastError else "")
+
+
+class RequestInspector:
+    """tracks the requests in flight, and the lag of the event loop
+
+    A request whose first attempt got its slot more than stallAfter seconds
+    ago, or that is retried for the warnAfter-th time (see RetryPolicy), counts as stalled, and so does
+    an event loop that did not run for loopStallAfter seconds. Stalls are
+    reported once on stderr, together with the eventual recovery, if the
+    request comes from a cdbAPI with showErrors=True. Event loop stalls are
+    reported while there are such requests in flight. A report of
+    the oldest requests is printed on SIGUSR1, and served as /inflight next
+    to the metrics, see Metrics.serve.
+    """
+
+    def __init__(self, stallAfter=120, loopStallAfter=1, interval=0.5, n=10):
+        self.stallAfter = stallAfter
+        self.loopStallAfter = loopStallAfter
+        self.interval = interval  # how often the monitor wakes up
+        self.n = n  # number of requests shown in a report
+        self.requests = set()
+        self.loopLag = self.maxLoopLag = 0
+        self.monitors = {}  # event loop -> asyncio.Task
+
+    def begin(self, action, fen, showErrors=False):
+        request = InflightRequest(action, fen, showErrors)
+        self.requests.add(request)
+        return request
+
+    def end(self, request, success=True):
+        self.requests.discard(request)
+        if request.warned and request.showErrors:
+            self.warn(f"{'recovered' if success else 'gave up on'} request {request}")
+
+    def stalled(self, request):
+        if not request.warned:
+            request.warned = True
+            if request.showErrors:
+                self.warn(f"stalled request {request}")
+
+    def warn(self, message):
+        print(f"{datetime.now().isoformat()} - {message}", file=sys.stderr)
+
+    def oldest(self, n=None):
+        return sorted(self.requests, key=lambda r: r.started)[: n or self.n]
+
+    def report(self, n=None):
+        states = collections.Counter(r.state for r in self.requests)
+        lines = [
+            f"{datetime.now().isoformat()} - {len(self.requests)} requests in flight"
+            + "".join(f", {v} {k}" for k, v in sorted(states.items()))
+            + f". Event loop lag {self.loopLag:.3f}s, max {self.maxLoopLag:.3f}s."
+        ]
+        lines += [f"  {r}" for r in self.oldest(n)]
+        return "\n".join(lines) + "\n"
+
+    def start(self):
+        # starts the monitor on the running event loop, if not yet done
+        loop = asyncio.get_running_loop()
+        if loop in self.monitors:
+            return
+        self.monitors[loop] = loop.create_task(self.__monitor())
+        if hasattr(signal, "SIGUSR1"):
+            try:
+                loop.add_signal_handler(signal.SIGUSR1, self.__dump)
+            except (NotImplementedError, RuntimeError, ValueError):
+                pass  # not in the main thread, or not supported by the loop
+
+    def __dump(self):
+        print(self.report(), file=sys.stderr, flush=True)
+
+    async def __monitor(self):
+        while True:
+            tic = time.monotonic()
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            self.loopLag = max(0, now - tic - self.interval)
+            self.maxLoopLag = max(self.maxLoopLag, self.loopLag)
+            if self.loopLag >= self.loopStallAfter and any(
+                r.showErrors for r in self.requests
+            ):
+                self.warn(f"event loop was blocked for {self.loopLag:.1f}s")
+            for request in list(self.requests):
+                sent = request.sent
+                if not request.warned and sent and now - sent >= self.stallAfter:
+                    self.stalled(request)
+
+
+# the inspector that all cdbAPI objects report to by default
+INSPECTOR = RequestInspector()
+METRICS.set("cdblib_loop_lag_seconds", lambda: INSPECTOR.loopLag)
+METRICS.set("cdblib_calls_inflight", lambda: len(INSPECTOR.requests))
+METRICS.help["cdblib_loop_lag_seconds"] = "recent delay of the event loop"
+METRICS.help["cdblib_calls_inflight"] = "calls waiting for cdb, including their retries"
+METRICS.pages["/inflight"] = lambda params: INSPECTOR.report(int(params.get("n", 0)))
+
+
+class TraceSink:
+    """writes one compact json line per HTTP attempt of cdbAPI to a gzipped file
+
+    Each record holds the wall-clock time "t" at which the attempt started,
+    the action, board, attempt number and outcome, and the time in seconds
+    spent waiting for the rate limit and for a slot ("queue"), for a thread of
+    the executor ("executor", requests transport only), on the network, and
+    decoding the json. Once the file holds maxBytes of uncompressed records,
+    it is rotated to FILENAME.1, FILENAME.2, ..., keeping at most backups old
+    files. Sinks for the same file are shared within a process.
+    """
+
+    _sinks = {}  # filename -> TraceSink
+
+    def __init__(self, filename, maxBytes=256 * 2**20, backups=5):
+        self.filename = filename
+        self.maxBytes = maxBytes
+        self.backups = backups
+        self.records = 0
+        self.__open()
+        atexit.register(self.close)
+
+    @classmethod
+    def shared(cls, filename):
+        if filename not in cls._sinks:
+            cls._sinks[filename] = cls(filename)
+        return cls._sinks[filename]
+
+    def __open(self):
+        # fast compression, as the tracing should hardly cost any time itself
+        self.file = gzip.open(self.filename, "wt", compresslevel=1)
+        self.written = 0
+
+    def rotate(self):
+        self.file.close()
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.filename}.{i}"):
+                os.replace(f"{self.filename}.{i}", f"{self.filename}.{i + 1}")
+        if self.backups > 0:
+            os.replace(self.filename, f"{self.filename}.1")
+        self.__open()
+
+    def write(self, record):
+        line = json.dumps(record, separators=(",", ":")) + "\n"
+        self.file.write(line)
+        self.records += 1
+        self.written += len(line)
+        if self.written >= self.maxBytes:
+            self.rotate()
+
+    def close(self):
+        self.file.close()
+
+
+def default_trace():
+    # the environment variable CDBLIB_TRACE may name a file for a TraceSink
+    filename = os.environ.get("CDBLIB_TRACE")
+    return TraceSink.shared(filename) if filename else None
+
+
+class _StageTimer:
+    # context manager that adds its time and a call to totals = [s, calls]
+    __slots__ = ("totals", "tic")
+
+    def __init__(self, totals):
+        self.totals = totals
+
+    def __enter__(self):
+        self.tic = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.totals[0] += time.perf_counter() - self.tic
+        self.totals[1] += 1
+
+
+class Profiler:
+    """stage timers, CPU profile and peak memory of a script run
+
+    The scripts wrap their local work in stages, e.g.
+        with cdblib.PROFILER.stage("parse"):
+            ...
+    which costs next to nothing unless profiling was started. Stages must not
+    contain an await, as they would then also time the other tasks. The time
+    spent waiting for cdb is taken from METRICS, and the time the event loop
+    was idle, i.e. waited for I/O, from the CPU profile of the main thread.
+    The report is written at exit, together with the raw profile in
+    FILENAME.prof, e.g. for use with snakeviz.
+    """
+
+    # the functions in which the event loop of the main thread waits for I/O
+    IDLE = ("poll", "select", "control")
+
+    def __init__(self):
+        self.filename = None
+        self.stages = collections.defaultdict(lambda: [0, 0])  # name -> [s, calls]
+        self.profile = None
+        self.__idle = nullcontext()
+
+    def start(self, filename):
+        # filename None leaves the profiler disabled
+        if filename is None or self.filename is not None:
+            return
+        self.filename = filename
+        self.tic, self.cpu = time.perf_counter(), time.process_time()
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+        atexit.register(self.stop)
+
+    def stage(self, name):
+        if self.filename is None:
+            return self.__idle
+        return _StageTimer(self.stages[name])
+
+    def stop(self):
+        # stops profiling and writes the report
+        if self.profile is None:
+            return
+        self.profile.disable()
+        wall = time.perf_counter() - self.tic
+        cpu = time.process_time() - self.cpu
+        stats = pstats.Stats(self.profile, stream=io.StringIO())
+        self.profile.dump_stats(self.filename + ".prof")
+        self.profile = None
+        idle = sum(
+            v[2]  # e.g. "<method 'poll' of 'select.epoll' objects>"
+            for (file, _, func), v in stats.stats.items()
+            if file == "~"
+            and " of 'select." in func
+            and func.split()[1].strip("'") in self.IDLE
+        )
+        lines = [
+            f"Profile of: {' '.join(sys.argv)}",
+            f"Wall time {wall:.2f}s, CPU time {cpu:.2f}s (all threads).",
+            f"Event loop waiting for I/O: {idle:.2f}s.",
+        ]
+        if resource is not None:
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            peak /= 2**20 if sys.platform == "darwin" else 2**10  # bytes or KB
+            lines.append(f"Peak memory (max RSS): {peak:.1f}MB.")
+        calls = METRICS.histograms.items()
+        count = sum(h[2] for (name, _), h in calls if name == "cdblib_call_seconds")
+        total = sum(h[1] for (name, _), h in calls if name == "cdblib_call_seconds")
+        lines.append(
+            f"Requests to cdb: {count}, taking {total:.2f}s in total (they overlap)."
+        )
+        lines += ["", f"{'stage':<12}{'seconds':>10}{'calls':>10}{'share':>8}"]
+        for name, (seconds, n) in sorted(self.stages.items(), key=lambda i: -i[1][0]):
+            share = f"{100 * seconds / wall:.1f}%" if wall else ""
+            lines.append(f"{name:<12}{seconds:>10.3f}{n:>10}{share:>8}")
+        with open(self.filename, "w") as f:
+            print("\n".join(lines) + "\n", file=f)
+            for sort in ("cumulative", "tottime"):
+                stats.stream = f
+                print(f"Main thread profile, sorted by {sort}:", file=f)
+                stats.sort_stats(sort).print_stats(30)
+
+
+# the profiler that the scripts start with --profile
+PROFILER = Profiler()
+
+
+def normalize_fen(fen):
+    # drops the move counters, which cdb ignores, but keeps any "moves ..."
+    parts = fen.split()
+    if "moves" in parts:
+        i = parts.index("moves")
+        return " ".join(parts[: min(i, 4)] + parts[i:])
+    return " ".join(parts[:4])
+
+
+def child_score(score):
+    # turns cdb's score of a move into the eval of the resulting position,
+    # where mate, TB win and cursed win scores count the plies to the end
+    if score > 15000:
+        return -(score + 1)
+    if score < -15000:
+        return -score + 1
+    return -score
+
+
+class ResponseCache:
+    """persistent cache for the replies of the API, stored in SQLite
+
+    Replies are keyed by action, normalized FEN and options, and expire after
+    a time-to-live that depends on the action and the reply's status. Once
+    the cache holds more than maxEntries replies, the least recently used
+    ones are evicted. The default filename ":memory:" gives a cache that only
+    lives as long as the process.
+
+    A read-only request that is not cached itself may be answered from a
+    fresh cached reply to a richer request, see SOURCES. Requests that
+    trigger learning on cdb always reach the server, their replies are only
+    stored to answer read-only requests.
+    With prefillChildren the scores in queryall/showall replies are also
+    stored as provisional evals of the child positions, without "ply".
+    With prefillPVs the suffixes of the PVs in querypv replies are stored
+    as provisional stable PVs of the positions along the PV.
+
+    Several processes may share a cache file. Every write is a transaction
+    of its own, and a cache that stays locked by another process for more
+    than busyTimeout seconds gives a miss, or drops the write, instead of
+    an error.
+    """
+
+    # the actions that are cached, others always reach the server
+    ACTIONS = ("queryall", "queryscore", "querypv", "querysearch")
+    # replies that were not received but implied by others
+    DERIVED = ("childscore", "pvsuffix")
+
+    # time-to-live in seconds, looked up for (action, status), then status
+    TTL = {
+        "checkmate": 365 * 86400,
+        "stalemate": 365 * 86400,
+        "invalid board": 365 * 86400,
+        "ok": 86400,
+        ("querypv", "ok"): 6 * 3600,
+        "unknown": 60,
+        "nobestmove": 60,
+        ("childscore", "ok"): 3600,
+        ("pvsuffix", "ok"): 3600,
+    }
+
+    # (action, optionString) -> the cached replies it may be derived from
+    SOURCES = {
+        ("queryall", ""): [("queryall", "&showall=1")],
+        ("queryscore", "&learn=0"): [
+            ("queryscore", ""),
+            ("queryall", ""),
+            ("queryall", "&showall=1"),
+            ("childscore", ""),
+        ],
+        ("querypv", "&stable=1"): [("pvsuffix", "")],
+    }
+
+    def __init__(
+        self,
+        filename=":memory:",
+        ttl=None,
+        maxEntries=10**7,
+        prefillChildren=False,
+        prefillPVs=False,
+        busyTimeout=0.2,
+    ):
+        self.filename = filename
+        self.prefillChildren = prefillChildren
+        self.prefillPVs = prefillPVs
+        self.ttl = dict(self.TTL)
+        if ttl:
+            self.ttl.update(ttl)
+        self.maxEntries = maxEntries
+        # autocommit, so that no transaction holds the lock between writes
+        self.db = sqlite3.connect(
+            filename,
+            timeout=busyTimeout,
+            isolation_level=None,
+            check_same_thread=False,
+        )
+        if filename != ":memory:":
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS replies "
+            "(key TEXT PRIMARY KEY, reply TEXT, expires REAL, accessed REAL)"
+        )
+        self.db.execute(
+            "CREATE INDEX IF NOT EXISTS replies_accessed ON replies (accessed)"
+        )
+        self.hits = AtomicInteger()
+        self.misses = AtomicInteger()
+        self.evicted = AtomicInteger()
+        self.derived = AtomicInteger()
+        self.locked = AtomicInteger()  # lookups and writes lost to a busy cache
+        self.__writes = 0
+        atexit.register(self.close)
+
+    @staticmethod
+    def key(action, fen, optionString=""):
+        return f"{action}|{normalize_fen(fen)}|{optionString}"
+
+    def get(self, action, fen, optionString=""):
+        # returns a fresh cached reply or None
+        if action not in self.ACTIONS or not is_read_only(action, optionString):
+            return None
+        try:
+            content = self.__lookup(action, fen, optionString)
+            if content is None:
+                for source, sourceOptions in self.SOURCES.get(
+                    (action, optionString), []
+                ):
+                    reply = self.__lookup(source, fen, sourceOptions)
+                    if reply is not None:
+                        content = self.derive(action, source, reply)
+                        if content is not None:
+                            self.derived.inc()
+                            break
+        except sqlite3.OperationalError:  # e.g. database is locked
+            self.locked.inc()
             content = None
+        if content is None:
+            self.misses.inc()
+            return None
+        self.hits.inc()
         return content
 
-    async def __cdbapicall(self, action, timeout=15):
-        """co-routine to access the API"""
-        async with self.semaphoreAPI:
-            return await asyncio.get_running_loop().run_in_executor(
-                self.executorWork,
-                self.__apicall,
-                "http://www.chessdb.cn/cdb.php" + action,
-                timeout,
+    def __lookup(self, action, fen, optionString):
+        key, now = self.key(action, fen, optionString), time.time()
+        row = self.db.execute(
+            "SELECT reply, expires FROM replies WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None or row[1] < now:
+            return None
+        self.__write("UPDATE replies SET accessed = ? WHERE key = ?", (now, key))
+        return json_loads(row[0])
+
+    @staticmethod
+    def derive(action, source, reply):
+        # returns the reply to action implied by a reply to source, or None
+        status = reply.get("status")
+        if status in ("checkmate", "stalemate", "invalid board"):
+            return {"status": status}
+        if status != "ok":
+            return None  # e.g. showall lists all moves with "??" if unknown
+        if (action, source) in (
+            ("queryscore", "queryscore"),
+            ("queryscore", "childscore"),
+            ("querypv", "pvsuffix"),
+        ):
+            return reply  # e.g. a learning request's reply serves a read-only one
+        # queryall lists the scored moves, showall all moves with "??" for
+        # the unscored ones, and cdb's eval of a position is the top score
+        moves = [m for m in reply.get("moves", []) if type(m.get("score")) == int]
+        if not moves:
+            return None
+        if action == "queryall":
+            return dict(reply, moves=moves)
+        content = {"status": "ok", "eval": moves[0]["score"]}
+        if "ply" in reply:
+            content["ply"] = reply["ply"]
+        return content
+
+    def put(self, action, fen, optionString, content):
+        if action == "queue":
+            self.invalidate(fen)  # the position will be (re)analysed now
+            return
+        if action not in self.ACTIONS:
+            return
+        status = content.get("status")
+        ttl = self.ttl.get((action, status), self.ttl.get(status, 0))
+        if ttl <= 0:
+            return
+        reply = {k: v for k, v in content.items() if k != "fen"}
+        self.__store(self.key(action, fen, optionString), reply, ttl)
+        if self.prefillChildren and action == "queryall" and status == "ok":
+            self.__prefill_children(fen, reply.get("moves", []))
+        if self.prefillPVs and action == "querypv" and status == "ok":
+            self.__prefill_pvs(fen, reply)
+
+    def __store(self, key, reply, ttl):
+        now = time.time()
+        self.__write(
+            "INSERT OR REPLACE INTO replies VALUES (?, ?, ?, ?)",
+            (key, json.dumps(reply), now + ttl, now),
+        )
+
+    def __prefill_children(self, fen, moves):
+        # a move's score is the negated eval of the child position
+        ttl = self.ttl.get(("childscore", "ok"), 0)
+        if ttl <= 0 or "moves" in fen.split():
+            return
+        try:
+            board = chess.Board(normalize_fen(fen))
+        except ValueError:
+            return
+        for m in moves:
+            score = m.get("score")
+            if type(score) != int or abs(score) >= 29999:
+                continue  # unscored, or the child is (mated) checkmate
+            try:
+                board.push_uci(m["uci"])
+            except (KeyError, ValueError):
+                continue
+            reply = {"status": "ok", "eval": child_score(score)}
+            self.__store(self.key("childscore", board.epd()), reply, ttl)
+            board.pop()
+
+    def __prefill_pvs(self, fen, reply):
+        # the PV of a position after k plies along a PV is its k-th suffix
+        ttl = self.ttl.get(("pvsuffix", "ok"), 0)
+        pv, pvSAN, score = reply.get("pv", []), reply.get("pvSAN", []), reply["score"]
+        if ttl <= 0 or "moves" in fen.split() or type(score) != int:
+            return
+        if len(pv) != len(pvSAN):
+            return
+        try:
+            board = chess.Board(normalize_fen(fen))
+        except ValueError:
+            return
+        depth = reply.get("depth", len(pv))
+        for k in range(1, len(pv)):
+            if abs(score) >= 29999:
+                break  # no PV left in a (mated) checkmate
+            try:
+                board.push_uci(pv[k - 1])
+            except ValueError:
+                break
+            score = child_score(score)
+            suffix = {
+                "status": "ok",
+                "score": score,
+                "depth": max(depth - k, 1),
+                "pv": pv[k:],
+                "pvSAN": pvSAN[k:],
+            }
+            self.__store(self.key("pvsuffix", board.epd()), suffix, ttl)
+
+    def invalidate(self, fen):
+        # removes all the cached replies for the given position
+        for action in self.ACTIONS + self.DERIVED:
+            prefix = self.key(action, fen, "")
+            self.__write(
+                "DELETE FROM replies WHERE key >= ? AND key < ?",
+                (prefix, prefix + "\uffff"),
+            )
+
+    def __write(self, sql, parameters):
+        # a single write, which is dropped if the cache is busy for too long
+        try:
+            self.db.execute(sql, parameters)
+            self.__writes += 1
+            if self.__writes >= 1000:
+                self.__writes = 0
+                self.__evict()
+        except sqlite3.OperationalError:  # e.g. database is locked
+            self.locked.inc()
+
+    def __evict(self):
+        # evict the least recently used entries, plus some headroom
+        (count,) = self.db.execute("SELECT COUNT(*) FROM replies").fetchone()
+        if count > self.maxEntries:
+            excess = count - self.maxEntries + self.maxEntries // 10
+            self.db.execute(
+                "DELETE FROM replies WHERE key IN "
+                "(SELECT key FROM replies ORDER BY accessed LIMIT ?)",
+                (excess,),
+            )
+            self.evicted.inc(excess)
+
+    def close(self):
+        try:
+            self.db.close()
+        except sqlite3.ProgrammingError:
+            pass  # closed already
+
+    def stats(self):
+        h, m, locked = self.hits.get(), self.misses.get(), self.locked.get()
+        return (
+            f"Cache hit rate: {h}/{h+m} = {h/max(h+m,1)*100:.2f}%"
+            f" ({self.derived.get()} derived from other replies)."
+            + (f" {locked} lookups or writes failed on a busy cache." if locked else "")
+        )
+
+
+class EPDOracle:
+    """local scores for positions, read from scored EPD files
+
+    The files are in the output format of fens2cdb.py, i.e. lines with
+    "; cdb eval: E, ply: P;" or just "; cdb eval: E;". If a position appears
+    several times, the entry with the smallest ply is kept. The positions
+    are indexed in SQLite, and with a filename for index the index is kept
+    on disk and only rebuilt once the scored EPD files change.
+    """
+
+    def __init__(self, filenames, index=":memory:"):
+        self.db = sqlite3.connect(index, check_same_thread=False)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS oracle "
+            "(fen TEXT PRIMARY KEY, eval TEXT, ply INTEGER)"
+        )
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS sources "
+            "(filename TEXT, mtime REAL, size INTEGER)"
+        )
+        sources = [(f, os.path.getmtime(f), os.path.getsize(f)) for f in filenames]
+        if self.db.execute("SELECT * FROM sources").fetchall() != sources:
+            self.db.execute("DELETE FROM oracle")
+            self.db.execute("DELETE FROM sources")
+            for filename in filenames:
+                self.__read(filename)
+            self.db.executemany("INSERT INTO sources VALUES (?, ?, ?)", sources)
+            self.db.commit()
+        self.hits = AtomicInteger()
+        self.misses = AtomicInteger()
+
+    def __read(self, filename):
+        def scores():
+            with open_file_rt(filename) as f:
+                for line in f:
+                    line = line.strip()
+                    if not line or line.startswith("#"):
+                        continue
+                    _, p, cdb = line.rpartition(" cdb eval: ")
+                    if not p or cdb in ("", ";"):
+                        continue
+                    score, _, ply = cdb.rstrip(";").partition(", ply: ")
+                    fen = " ".join(line.split()[:4]).rstrip(";")
+                    yield fen, score, int(ply) if ply else None
+
+        self.db.executemany(
+            "INSERT INTO oracle VALUES (?, ?, ?) ON CONFLICT (fen) DO UPDATE SET "
+            "eval = excluded.eval, ply = excluded.ply WHERE excluded.ply IS NOT NULL "
+            "AND (oracle.ply IS NULL OR oracle.ply > excluded.ply)",
+            scores(),
+        )
+
+    def __len__(self):
+        return self.db.execute("SELECT COUNT(*) FROM oracle").fetchone()[0]
+
+    def get(self, fen):
+        # returns a queryscore reply for fen, or None if it is not known
+        row = self.db.execute(
+            "SELECT eval, ply FROM oracle WHERE fen = ?", (normalize_fen(fen),)
+        ).fetchone()
+        content = None if row is None else eval2json(row[0])
+        if content is None:
+            self.misses.inc()
+            return None
+        self.hits.inc()
+        if row[1] is not None:
+            content["ply"] = row[1]
+        return content
+
+    def stats(self):
+        h, m = self.hits.get(), self.misses.get()
+        return f"Oracle hit rate: {h}/{h+m} = {h/max(h+m,1)*100:.2f}%."
+
+
+class cdbAPI:
+    _clients = AtomicInteger()  # numbers the instances, to label their gauges
+
+    def __init__(
+        self,
+        concurrency,
+        user=None,
+        showErrors=True,
+        transport="requests",
+        poolSize=None,
+        warmup=0,
+        minConcurrency=None,
+        maxConcurrency=None,
+        rateLimit=None,
+        rateLimitFile=None,
+        rateWeight=1,
+        retryPolicy=None,
+        circuitBreaker=None,
+        hedgeFraction=0,
+        hedgeDelay=1,
+        endpoints=None,
+        cache=None,
+        oracle=None,
+        offline=False,
+        typed=False,
+        metrics=None,
+        inspector=None,
+        trace=None,
+    ):
+        # transport can be "requests" (blocking requests in a thread pool),
+        # "asyncio" (native non-blocking HTTP client) or a transport object
+        # poolSize is the number of keep-alive connections (default: concurrency)
+        # warmup > 0 opens that many connections already at construction
+        # with minConcurrency and/or maxConcurrency the concurrency adapts to
+        # the server's replies within these bounds, starting at concurrency
+        # rateLimit is a budget of requests per second for all the processes on
+        # the host that share rateLimitFile, split according to rateWeight
+        # retryPolicy is a RetryPolicy object, controlling timeouts and back-off
+        # circuitBreaker is a CircuitBreaker object, or False to disable it
+        # hedgeFraction > 0 allows read-only requests that take longer than the
+        # p95 latency (or hedgeDelay before enough replies were seen) to be
+        # duplicated, for at most this fraction of the read-only requests;
+        # duplicates only use idle slots and rate limit tokens, so they are
+        # rare under load, but each one is an extra request to cdb
+        # endpoints is a list of URLs of the API (default: default_endpoints())
+        # cache is a ResponseCache object, or the filename of one
+        # oracle is an EPDOracle that answers queryscore requests for the
+        # positions it knows, with offline=True it answers all of them and
+        # any other request raises an OfflineError
+        # typed=True makes all the methods return cdbReply objects, not dicts
+        # metrics is the Metrics registry to report to (default: METRICS)
+        # inspector is the RequestInspector to report to (default: INSPECTOR)
+        # trace may be a TraceSink or a filename for one, to trace every HTTP
+        # attempt, by default CDBLIB_TRACE is used
+        self.user = "" if user is None else str(user)
+        self.showErrors = showErrors
+        # a limiter for the number of concurrent accesses to the API
+        self.limiter = AdaptiveLimiter(concurrency, minConcurrency, maxConcurrency)
+        if isinstance(transport, str):
+            transport = TRANSPORTS[transport](
+                self.limiter.maxLimit,
+                "cdblib" + bool(self.user) * "/" + self.user,
+                poolSize,
+            )
+        self.transport = cassette_transport(transport)
+        if endpoints is None:
+            endpoints = default_endpoints()
+        self.router = EndpointRouter(endpoints)
+        if isinstance(cache, str):
+            cache = ResponseCache(cache)
+        self.cache = cache
+        self.oracle = oracle
+        self.offline = offline
+        self.typed = typed
+        self.metrics = METRICS if metrics is None else metrics
+        self.metrics.start_from_env()
+        self.inspector = INSPECTOR if inspector is None else inspector
+        if isinstance(trace, str):
+            trace = TraceSink.shared(trace)
+        self.trace = default_trace() if trace is None else trace
+        # the gauges of each instance have their own label, and only hold a
+        # weak reference, so that they disappear with the instance
+        limiter, client = weakref.ref(self.limiter), self._clients.inc()
+        for name, attr in (
+            ("cdblib_inflight", "inflight"),
+            ("cdblib_waiting", "waiting"),
+            ("cdblib_concurrency_limit", "limit"),
+        ):
+            self.metrics.set(
+                name, lambda attr=attr: getattr(limiter(), attr, None), client=client
+            )
+        self.retryPolicy = RetryPolicy() if retryPolicy is None else retryPolicy
+        if circuitBreaker is None:
+            circuitBreaker = CircuitBreaker(showErrors=showErrors)
+        self.circuitBreaker = circuitBreaker or None
+        self.rateLimiter = None
+        if rateLimit:
+            self.rateLimiter = SharedRateLimiter(rateLimit, rateLimitFile, rateWeight)
+        # identical requests that are in flight at the same time are merged
+        self.inflight = {}  # (action, fen, optionString) -> asyncio.Task
+        self.waiters = collections.Counter()  # asyncio.Task -> number of callers
+        self.requested = AtomicInteger()
+        self.coalesced = AtomicInteger()
+        self.hedgeFraction = hedgeFraction
+        self.hedgeDelay = hedgeDelay
+        self.hedgeable = AtomicInteger()
+        self.hedged = AtomicInteger()
+        self.hedgeWins = AtomicInteger()
+        self.warmupTask = None
+        if warmup > 0 and hasattr(self.transport, "warmup"):
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                loop = None  # no event loop yet: nothing can be opened
+            if loop is not None:
+                self.warmupTask = loop.create_task(self.warmup(warmup))
+
+    async def warmup(self, n):
+        """co-routine that pre-opens n keep-alive connections to the API"""
+        await self.transport.warmup(self.router.pick(), n)
+
+    @property
+    def concurrencyLimit(self):
+        """the current limit on concurrent requests"""
+        return self.limiter.limit
+
+    async def __attempt(
+        self,
+        action,
+        timeout,
+        priority,
+        acquired=False,
+        request=None,
+        holding=None,
+        exclude=None,
+    ):
+        """co-routine for a single request, returns the json or a FailedAttempt"""
+        # acquired means that the slot and rate limit token are held already,
+        # holding is a future that gets the endpoint once a slot is held,
+        # exclude an endpoint to avoid if possible
+        queued, timing, body, kind = time.monotonic(), {}, b"", None
+        received = None
+        if not acquired:
+            await self.limiter.acquire(priority)
+        if self.rateLimiter is not None and not acquired:
+            # only with a slot, as otherwise the priorities would not matter
+            if request is not None:
+                request.state = "waiting for rate limit"
+            try:
+                await self.rateLimiter.acquire(priority)
+            except BaseException:
+                self.limiter.release()
+                raise
+        started = time.monotonic()
+        if request is not None and not acquired:
+            request.state = "requesting"
+            if request.sent is None:
+                request.sent = started
+        endpoint = self.router.pick(exclude)
+        if holding is not None:
+            holding.set_result(endpoint)
+        try:
+            body = await self.transport.get(endpoint + action, timeout, timing)
+            received = time.monotonic()
+            timing["network"] = received - started - timing.get("executor", 0)
+            self.metrics.inc("cdblib_received_bytes_total", len(body))
+            content = json_loads(body)
+            timing["decode"] = time.monotonic() - received
+            latency = received - started
+            self.retryPolicy.latency.add(latency)
+            self.metrics.observe(
+                "cdblib_request_seconds", latency, action=query_action(action)
+            )
+            self.router.record(endpoint, True, latency)
+        except CassetteMissError:
+            raise  # retrying cannot help
+        except Exception as e:
+            if "network" not in timing:  # the time until the error
+                failed = time.monotonic()
+                timing["network"] = failed - started - timing.get("executor", 0)
+            if isinstance(e, (asyncio.TimeoutError, requests.Timeout)):
+                kind = "timeout"
+            elif isinstance(e, ValueError) and received is not None:
+                kind = "invalid json"
+            else:
+                kind = "network"
+            content = FailedAttempt(kind)
+            if content.answered:
+                self.router.record(endpoint, True, received - started)
+            else:
+                self.router.record(endpoint, False)
+            self.metrics.inc("cdblib_errors_total", kind=kind)
+        finally:
+            self.limiter.release()
+        if self.trace is not None and request is not None:
+            self.__trace(
+                request, queued, started, timing, body, content, kind, acquired
+            )
+        if isinstance(content, FailedAttempt):
+            if not content.answered:
+                self.limiter.congestion(started)
+        elif type(content) == dict and content.get("status") == "rate limit exceeded":
+            self.limiter.congestion(started)
+        else:
+            self.limiter.success()
+        return content
+
+    def __trace(self, request, queued, started, timing, body, content, kind, hedge):
+        # writes the trace record of an attempt, see TraceSink
+        record = {
+            "t": round(time.time() - (time.monotonic() - queued), 3),
+            "action": request.action,
+            "board": request.fen,
+            "attempt": request.attempt,
+            "queue": round(started - queued, 4),
+        }
+        for key in ("executor", "network", "decode"):
+            if key in timing:
+                record[key] = round(timing[key], 4)
+        if type(content) is dict:
+            record["status"] = content.get("status")
+        else:
+            record["error"] = kind or "not a json object"
+        record["bytes"] = len(body)
+        if hedge:
+            record["hedge"] = True
+        self.trace.write(record)
+
+    async def __hedged_attempt(self, action, timeout, priority, request=None):
+        """co-routine that sends a duplicate request if the first one is slow"""
+        self.hedgeable.inc()
+        delay = self.retryPolicy.latency.percentile(95)
+        if len(self.retryPolicy.latency) < 20:
+            delay = self.hedgeDelay
+        holding = asyncio.get_running_loop().create_future()
+        primary = self.__attempt(
+            action, timeout, priority, request=request, holding=holding
+        )
+        primary = asyncio.ensure_future(primary)
+        tasks = {primary}
+        try:
+            # the delay starts once the primary holds a slot and is sent
+            await asyncio.wait({primary, holding}, return_when=asyncio.FIRST_COMPLETED)
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if done or self.hedged.get() >= self.hedgeFraction * self.hedgeable.get():
+                return await primary
+            if not self.limiter.try_acquire():
+                return await primary  # hedging must not queue up for a slot
+            if self.rateLimiter is not None and not self.rateLimiter.try_acquire():
+                self.limiter.release()
+                return await primary  # nor for a rate limit token
+            self.hedged.inc()
+            # the duplicate goes to another healthy endpoint, if there is one
+            hedge = self.__attempt(
+                action, timeout, priority, True, request, exclude=holding.result()
             )
+            tasks.add(asyncio.ensure_future(hedge))
+            while tasks:
+                done, tasks = await asyncio.wait(
+                    tasks, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    content = task.result()
+                    if not isinstance(content, FailedAttempt):
+                        if task is not primary:
+                            self.hedgeWins.inc()
+                        return content
+            return content
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def __cdbapicall(
+        self, action, timeout=15, hedge=False, priority=PRIORITY_NORMAL, request=None
+    ):
+        """co-routine to access the API"""
+        breaker = self.circuitBreaker
+        probe = breaker is not None and await breaker.admit()
+        try:
+            if hedge and self.hedgeFraction > 0 and not probe:
+                content = await self.__hedged_attempt(
+                    action, timeout, priority, request
+                )
+            else:
+                content = await self.__attempt(
+                    action, timeout, priority, False, request
+                )
+        except BaseException:
+            # e.g. cancelled or a cassette miss
+            if probe:
+                breaker.record(False, probe)  # schedules the next probe
+            raise
+        if breaker is not None:
+            failed = isinstance(content, FailedAttempt) and not content.answered
+            breaker.record(not failed, probe)
+        return content
 
-    async def generic_call(self, action, fen, optionString=""):
+    async def generic_call(self, action, fen, optionString="", priority=None):
         # action can be: "queryall", "querybest", "query", "querysearch", "queryscore", "querypv", "queue"
         # returns dict from API call to chessdb.cn with "status" guaranteed to be one of: "ok", "checkmate", "stalemate", "unknown", "nobestmove", "invalid board"
-        timeout = 5
+        # priority is one of PRIORITY_INTERACTIVE, PRIORITY_NORMAL, PRIORITY_BACKGROUND, with "queue" requests defaulting to the latter
+        # concurrent calls with identical arguments share a single request, sent with the priority of the first caller
+        if priority is None:
+            priority = PRIORITY_BACKGROUND if action == "queue" else PRIORITY_NORMAL
+        if self.oracle is not None and action == "queryscore":
+            content = self.oracle.get(fen)
+            if content is None and self.offline:
+                content = {"status": "unknown"}
+            if content is not None:
+                self.metrics.inc("cdblib_calls_total", action=action, source="oracle")
+                content["fen"] = fen
+                return self.__reply(content)
+        if self.offline:
+            raise OfflineError(f"Cannot {action} {fen} offline")
+        if self.cache is not None:
+            content = self.cache.get(action, fen, optionString)
+            if content is not None:
+                self.metrics.inc("cdblib_calls_total", action=action, source="cache")
+                content["fen"] = fen
+                return self.__reply(content)
+        self.requested.inc()
+        key = (action, fen, optionString)
+        task = self.inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(
+                self.__tracked_call(action, fen, optionString, priority)
+            )
+            self.inflight[key] = task
+            task.add_done_callback(lambda _: self.__forget(key, task))
+            self.metrics.inc("cdblib_calls_total", action=action, source="cdb")
+        else:
+            self.coalesced.inc()
+            self.metrics.inc("cdblib_calls_total", action=action, source="coalesced")
+        # a cancelled caller must not cancel the request for the other callers,
+        # but once all of them are gone the request is abandoned
+        self.waiters[task] += 1
+        try:
+            content = await asyncio.shield(task)
+        finally:
+            self.waiters[task] -= 1
+            if not self.waiters[task]:
+                del self.waiters[task]
+                if not task.done():
+                    # later callers must not join the abandoned request
+                    self.__forget(key, task)
+                    task.cancel()
+        return self.__reply(content)
+
+    def __forget(self, key, task):
+        # removes task from the requests in flight, unless it was replaced
+        if self.inflight.get(key) is task:
+            del self.inflight[key]
+
+    def __reply(self, content):
+        # every caller gets its own copy, which it may modify
+        return cdbReply(content) if self.typed else dict(content)
+
+    async def __tracked_call(self, action, fen, optionString, priority):
+        self.inspector.start()
+        request = self.inspector.begin(action, fen, self.showErrors)
+        try:
+            content = await self.__generic_call(
+                action, fen, optionString, priority, request
+            )
+        except BaseException:
+            self.inspector.end(request, False)
+            raise
+        self.inspector.end(request)
+        return content
+
+    async def __generic_call(self, action, fen, optionString, priority, request):
+        policy = self.retryPolicy
+        readOnly = is_read_only(action, optionString)
         success = False
-        first = True
-        lasterror = ""
+        attempt, delay, tic = 0, 0, time.monotonic()
+        lasterror, reason, retried = "", None, None
+        metrics = self.metrics
 
         while not success:
             # sleep a bit before further requests
-            if not first:
-                # increase timeout after every attempt, up to a maximum
-                if timeout < 60:
-                    timeout = min(timeout * 1.5, 60)
-                elif self.showErrors:
-                    print(
-                        datetime.now().isoformat(),
-                        " - failed to get reply for : ",
-                        fen,
-                        " last error: ",
-                        lasterror,
-                        file=sys.stderr,
-                        flush=True,
+            if attempt:
+                if policy.exhausted(attempt, time.monotonic() - tic):
+                    raise RetryBudgetExceeded(
+                        f"No reply for {fen} after {attempt} attempts, last error: {lasterror}"
                     )
-                await asyncio.sleep(timeout)
-            else:
-                first = False
+                metrics.inc("cdblib_retries_total", reason=retried)
+                request.lastError = lasterror
+                if attempt >= policy.warnAfter:
+                    self.inspector.stalled(request)
+                request.state = "backing off"
+                delay = policy.delay(reason, delay)
+                await asyncio.sleep(delay)
 
+            metrics.inc("cdblib_requests_total", action=action)
+            request.attempt, request.state = attempt + 1, "waiting for slot"
+            started = time.monotonic()
             content = await self.__cdbapicall(
-                f"?action={action}&board={fen}{optionString}&json=1", timeout
+                f"?action={action}&board={fen}{optionString}&json=1",
+                policy.timeout(attempt),
+                readOnly,
+                priority,
+                request,
+            )
+            metrics.observe(
+                "cdblib_call_seconds", time.monotonic() - started, action=action
             )
+            attempt += 1
+            if isinstance(content, FailedAttempt):
+                status = "invalid json" if content.answered else "no reply"
+            else:
+                status = content.get("status", "none") if type(content) is dict else "?"
+            metrics.inc("cdblib_replies_total", action=action, status=status)
 
-            if content is None:
-                lasterror = f"Something went wrong with {action}{optionString}"
+            if isinstance(content, FailedAttempt):
+                if content.answered:
+                    lasterror = f"Invalid json reply for {action}{optionString}"
+                    reason, retried = policy.MALFORMED, "invalid json"
+                elif content.kind == "timeout":
+                    lasterror = f"Timeout for {action}{optionString}"
+                    reason, retried = policy.TIMEOUT, "timeout"
+                else:
+                    lasterror = f"Something went wrong with {action}{optionString}"
+                    reason, retried = policy.NETWORK, "no reply"
                 continue
 
             elif action == "queue" and content == {}:
@@ -124,6 +2415,7 @@ class cdbAPI:
 
             elif "status" not in content:
                 lasterror = "Malformed reply, not containing status"
+                reason, retried = policy.MALFORMED, "malformed"
                 continue
 
             elif content["status"] == "invalid board":
@@ -133,6 +2425,7 @@ class cdbAPI:
 
             elif content["status"] == "rate limit exceeded":
                 lasterror = "Rate limit exceeded"
+                reason, retried = policy.RATELIMIT, "rate limit"
                 continue
 
             elif content["status"] == "unknown":
@@ -175,6 +2468,7 @@ class cdbAPI:
                     )
                 ):
                     lasterror = "Unexpectedly missing keys"
+                    reason, retried = policy.MALFORMED, "missing keys"
                     continue
                 else:
                     success = True
@@ -184,62 +2478,155 @@ class cdbAPI:
 
             else:
                 lasterror = f"Surprise reply with status = {content['status']}"
+                reason, retried = policy.MALFORMED, "surprise status"
                 continue
 
+        if self.cache is not None:
+            self.cache.put(action, fen, optionString, content)
         content["fen"] = fen  # add "fen" key to dict, used e.g. for PV SAN
         return content
 
-    async def queryall(self, fen):
+    async def queryall(self, fen, priority=None):
         # returns dict with keys "status", "moves" and "ply" where "moves" is a sorted list of dict's with keys "uci", "san", "score", "rank", "note" and "winrate" (sorted by eval and rank)
         # goes 1 ply along scored moves, gets eval of these children, makes that the (updated) scores of the scored moves and reports these
-        return await self.generic_call("queryall", fen)
+        return await self.generic_call("queryall", fen, priority=priority)
 
-    async def showall(self, fen):
+    async def showall(self, fen, priority=None):
         # same as queryall, but returns _all_ possible moves, with "??" for score of unscored moves
-        return await self.generic_call("queryall", fen, "&showall=1")
+        return await self.generic_call("queryall", fen, "&showall=1", priority=priority)
 
-    async def querybest(self, fen):
+    async def querybest(self, fen, priority=None):
         # returns one of the rank == 2 moves in a dict with keys "status" and either "move", "search_moves or "egtb"
         # also triggers automatic back-propagation on cdb
-        return await self.generic_call("querybest", fen)
+        return await self.generic_call("querybest", fen, priority=priority)
 
-    async def query(self, fen):
+    async def query(self, fen, priority=None):
         # returns one of the rank > 0 moves in a dict with keys "status" and either "move", "search_moves or "egtb"
         # also triggers automatic back-propagation on cdb
-        return await self.generic_call("query", fen)
+        return await self.generic_call("query", fen, priority=priority)
 
-    async def querysearch(self, fen):
+    async def querysearch(self, fen, priority=None):
         # returns all of the rank > 0 moves in a dict with keys "status" and either "search_moves" or "egtb"
-        return await self.generic_call("querysearch", fen)
+        return await self.generic_call("querysearch", fen, priority=priority)
 
-    async def queryscore(self, fen):
+    async def queryscore(self, fen, priority=None):
         # returns dict with keys "status", "eval", "ply"
-        return await self.generic_call("queryscore", fen)
+        return await self.generic_call("queryscore", fen, priority=priority)
 
-    async def readscore(self, fen):
+    async def readscore(self, fen, priority=None):
         # returns dict with keys "status", "eval", "ply"
-        return await self.generic_call("queryscore", fen, "&learn=0")
+        return await self.generic_call("queryscore", fen, "&learn=0", priority=priority)
 
-    async def querypv(self, fen):
+    async def querypv(self, fen, priority=None):
         # returns dict with keys "status", "score", "depth", "pv", "pvSAN"
         # also triggers automatic back-propagation on cdb
-        return await self.generic_call("querypv", fen)
+        return await self.generic_call("querypv", fen, priority=priority)
 
-    async def querypvstable(self, fen):
+    async def querypvstable(self, fen, priority=None):
         # same as querypv, but returns _stable_ PV (always GUI's top move)
-        return await self.generic_call("querypv", fen, "&stable=1")
+        return await self.generic_call("querypv", fen, "&stable=1", priority=priority)
 
-    async def queue(self, fen):
+    async def queue(self, fen, priority=None):
         # returns dict with key "status"
         # schedules position for analysis, scoring at least 5 moves, and does some recursion
         # also triggers automatic back-propagation on cdb
-        return await self.generic_call("queue", fen)
+        return await self.generic_call("queue", fen, priority=priority)
+
+
+class cdbMove:
+    """a move in a queryall reply, with the keys of the reply as attributes
+
+    Keys that are missing in the reply are None. For existing code the
+    object can also be read like the dict it replaces, e.g. m["score"].
+    """
+
+    __slots__ = ("uci", "san", "score", "rank", "note", "winrate")
+
+    def __init__(self, d):
+        get = d.get
+        self.uci, self.san, self.score = get("uci"), get("san"), get("score")
+        self.rank, self.note, self.winrate = get("rank"), get("note"), get("winrate")
+
+    def __contains__(self, key):
+        return key in self.__slots__ and getattr(self, key) is not None
+
+    def __getitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def get(self, key, default=None):
+        return getattr(self, key) if key in self else default
+
+    def __repr__(self):
+        return f"cdbMove({self.uci}, {self.score})"
+
+
+class cdbReply:
+    """a reply of the API, with the keys of the reply as attributes
+
+    Keys that are missing in the reply are None, unknown keys are kept in
+    the dict extra. The moves of queryall replies are cdbMove objects. The
+    evaluation as given by json2eval and, for mate scores, the plies to mate
+    (negative if mated) are computed once, in evaluation and mate. For
+    existing code the object can also be read like the dict it replaces.
+    """
+
+    KEYS = ("status", "fen", "eval", "ply", "moves", "move", "search_moves")
+    KEYS += ("egtb", "score", "depth", "pv", "pvSAN")
+    __slots__ = tuple(k for k in KEYS if k != "moves")
+    __slots__ += ("_moves", "extra", "evaluation", "mate")
+
+    def __init__(self, d):
+        get = d.get
+        self.status, self.fen, self.eval = get("status"), get("fen"), get("eval")
+        self.ply, self._moves, self.move = get("ply"), get("moves"), get("move")
+        self.search_moves, self.egtb = get("search_moves"), get("egtb")
+        self.score, self.depth, self.pv = get("score"), get("depth"), get("pv")
+        self.pvSAN = get("pvSAN")
+        self.extra = None
+        if len(d) > sum(v is not None for v in map(get, self.KEYS)):
+            self.extra = {k: v for k, v in d.items() if k not in self.KEYS}
+        self.evaluation = json2eval(d)
+        s, self.mate = self.evaluation, None
+        if type(s) == str and s.lstrip("-").startswith("M"):
+            self.mate = int(s.replace("M", ""))
+
+    @property
+    def moves(self):
+        # the moves are turned into cdbMove objects on first access
+        if self._moves and type(self._moves[0]) == dict:
+            self._moves = list(map(cdbMove, self._moves))
+        return self._moves
+
+    def __contains__(self, key):
+        if key == "moves":
+            return self._moves is not None
+        if key in self.KEYS:
+            return getattr(self, key) is not None
+        return self.extra is not None and key in self.extra
+
+    def __getitem__(self, key):
+        if key in self.KEYS:
+            if (value := getattr(self, key)) is not None:
+                return value
+        elif self.extra is not None and key in self.extra:
+            return self.extra[key]
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def __repr__(self):
+        return f"cdbReply({self.status}, {self.evaluation})"
 
 
 def json2eval(r):
     # turns a json response from the API into an evaluation, if possible
     # output: on success eval/score E as reported by cdb, otherwise "mated", "invalid", f"{pc}men w/ cr" or ""
     # E is either "??" or an integer E. in the latter case 30000-ply = mate in ply, 20000-ply cursed win in ply, 25000-ply tb win in ply
+    if type(r) == cdbReply:
+        return r.evaluation  # computed once for the reply
     if r is None:  # only needed for buggy json responses from cdb
         return "invalid json reply"
     if "status" not in r:
@@ -273,6 +2660,24 @@ def json2eval(r):
     return s
 
 
+def eval2json(s):
+    # turns an evaluation as given by json2eval (or fens2cdb --shortFormat)
+    # back into a queryscore reply, if possible, otherwise returns None
+    s = str(s).strip()
+    if s in ("mated", "#"):
+        return {"status": "checkmate"}
+    if s == "invalid":
+        return {"status": "invalid board"}
+    sign, M, ply = s.rpartition("M")
+    if M and sign in ("", "-") and ply.isnumeric():
+        score = 30000 - int(ply)
+        return {"status": "ok", "eval": -score if sign else score}
+    try:
+        return {"status": "ok", "eval": int(s)}
+    except ValueError:
+        return None  # e.g. "7men w/ cr"
+
+
 def json2pv(r, san=False, ply=None):
     # turns the PV from a json response from the API into a string
     # output: PV as a string, if possible, otherwise ""
@@ -0,0 +1,377 @@
+"""
+   Local stand-in for chessdb.cn, to load-test the cdblib scripts offline.
+"""
+import argparse, asyncio, collections, json, math, random, sys, time
+import urllib.parse, chess, chess.polyglot, cdblib
+from datetime import datetime
+
+ACTIONS = ("queryall", "querybest", "query", "querysearch", "queryscore")
+ACTIONS += ("querypv", "queue")
+
+
+def latency_distribution(spec):
+    # returns a function that draws a latency in seconds, spec is one of
+    # "const:T", "uniform:A,B", "exp:MEAN", "lognormal:MEDIAN,SIGMA" and
+    # "pareto:MIN,ALPHA", the latter for heavy tails
+    name, _, args = spec.partition(":")
+    args = [float(a) for a in args.split(",") if a]
+    if name == "const" and len(args) == 1:
+        return lambda: args[0]
+    if name == "uniform" and len(args) == 2:
+        return lambda: random.uniform(*args)
+    if name == "exp" and len(args) == 1:
+        return lambda: random.expovariate(1 / args[0]) if args[0] > 0 else 0
+    if name == "lognormal" and len(args) == 2:
+        return lambda: random.lognormvariate(math.log(args[0]), args[1])
+    if name == "pareto" and len(args) == 2:
+        return lambda: args[0] * random.paretovariate(args[1])
+    raise ValueError(f"Unknown latency distribution {spec}")
+
+
+class cdbmock:
+    """answers cdb's API from synthetic scores or from local oracle files
+
+    Without oracle files, every position has a fixed pseudo-random score,
+    derived from its Zobrist key, and a fraction unknownFraction of them is
+    unknown. These scores are not consistent between a position and its
+    children. With oracle files, only the positions in these files are
+    known. Queued positions become known after queueDelay seconds. The
+    replies may be delayed, and be replaced by rate limit replies, malformed
+    json, replies with missing keys or dropped connections.
+    """
+
+    def __init__(
+        self,
+        latency="const:0",
+        rateLimited=0,
+        maxRate=None,
+        malformed=0,
+        missingKeys=0,
+        drop=0,
+        unknownFraction=0.1,
+        queueDelay=5,
+        oracle=None,
+        oracleIndex=None,
+    ):
+        self.latency = latency_distribution(latency)
+        self.rateLimited = rateLimited
+        self.maxRate = maxRate
+        self.recent = collections.deque()  # times of the requests in the last 1s
+        self.malformed = malformed
+        self.missingKeys = missingKeys
+        self.drop = drop
+        self.unknownFraction = unknownFraction
+        self.queueDelay = queueDelay
+        self.queued = {}  # Zobrist key -> time at which it becomes known
+        if oracle:
+            oracle = cdblib.EPDOracle(oracle, oracleIndex or ":memory:")
+        self.oracle = oracle
+        self.metrics = cdblib.Metrics()
+
+    def lookup(self, board):
+        # returns the queryscore reply of the oracle files, or one with a
+        # synthetic score, without "ply", or None if the position is unknown
+        key = chess.polyglot.zobrist_hash(board)
+        if self.oracle is not None:
+            content = self.oracle.get(board.epd())
+            if content is not None:
+                return content  # may also be "checkmate" or "invalid board"
+        elif (key >> 32) % 10**6 >= self.unknownFraction * 10**6:
+            return {"status": "ok", "eval": key % 401 - 200}
+        known = self.queued.get(key)
+        if known is not None and known <= time.monotonic():
+            return {"status": "ok", "eval": key % 401 - 200}
+        return None
+
+    def score(self, board):
+        # returns the score of the position for the side to move, None if unknown
+        content = self.lookup(board)
+        status = None if content is None else content.get("status")
+        if status == "ok":
+            return content["eval"]
+        if status == "checkmate":
+            return -(30000 - 1)  # like a checkmate on the board, see moves
+        if status == "stalemate":
+            return 0
+        return None
+
+    def ply(self, board):
+        # a pseudo-random distance from the root, or -1 for unconnected positions
+        key = chess.polyglot.zobrist_hash(board)
+        return -1 if key % 5 == 0 else len(board.move_stack) + (key >> 8) % 40
+
+    def moves(self, board, showall=False):
+        # the moves with their scores, sorted like cdb's queryall replies
+        moves = []
+        for move in board.legal_moves:
+            san = board.san(move)
+            board.push(move)
+            if board.is_checkmate():
+                score = 30000 - 1
+            elif board.is_stalemate() or board.is_insufficient_material():
+                score = 0
+            else:
+                score = self.score(board)
+                score = None if score is None else -score
+            board.pop()
+            if score is not None or showall:
+                moves.append({"uci": move.uci(), "san": san, "score": score})
+        moves.sort(key=lambda m: -math.inf if m["score"] is None else m["score"])
+        moves.reverse()
+        best = moves[0]["score"] if moves else None
+        for m in moves:
+            if m["score"] is None:
+                m.update(score="??", rank=0, note="? (??-??)", winrate="??")
+                continue
+            m["rank"] = 2 if best - m["score"] <= 5 else 1 if m["score"] >= -100 else 0
+            m["note"] = "! (00-00)" if m["rank"] == 2 else "* (00-00)"
+            winrate = 100 / (1 + math.exp(-m["score"] / 200))
+            m["winrate"] = f"{winrate:.2f}"
+        return moves
+
+    def reply(self, action, board, params):
+        # returns the json reply of cdb for the action and board
+        if board.is_checkmate():
+            return {"status": "checkmate"} if action != "queue" else {}
+        if board.is_stalemate():
+            return {"status": "stalemate"} if action != "queue" else {}
+        if action == "queue":
+            key = chess.polyglot.zobrist_hash(board)
+            self.queued.setdefault(key, time.monotonic() + self.queueDelay)
+            return {"status": "ok"}
+        if action == "queryscore":
+            content = self.lookup(board)
+            if content is None:
+                return {"status": "unknown"}
+            if content.get("status") != "ok":
+                return {"status": content.get("status")}
+            content = {"status": "ok", "eval": content["eval"]}
+            if (ply := self.ply(board)) >= 0:
+                content["ply"] = ply
+            return content
+        moves = self.moves(board, params.get("showall") == "1")
+        if not moves or moves[0]["score"] == "??":
+            # like cdb, the move requests have their own status for this
+            if action in ("querybest", "query", "querysearch"):
+                return {"status": "nobestmove"}
+            return {"status": "unknown"}
+        if action == "queryall":
+            return {"status": "ok", "moves": moves, "ply": self.ply(board)}
+        if action in ("querybest", "query"):
+            return {"status": "ok", "move": moves[0]["uci"]}
+        if action == "querysearch":
+            best = [m for m in moves if m["rank"] == 2]
+            return {
+                "status": "ok",
+                "search_moves": [{"uci": m["uci"], "san": m["san"]} for m in best],
+            }
+        # querypv: follow the best moves while they are known
+        content = {"status": "ok", "score": moves[0]["score"], "depth": 0}
+        content.update(pv=[], pvSAN=[])
+        while moves and moves[0]["score"] != "??" and content["depth"] < 50:
+            content["pv"].append(moves[0]["uci"])
+            content["pvSAN"].append(moves[0]["san"])
+            content["depth"] += 1
+            board.push_uci(moves[0]["uci"])
+            if board.is_game_over() or board.is_repetition(2):
+                break
+            moves = self.moves(board)
+        return content
+
+    def fault(self):
+        # returns the fault to inject into the next reply, if any
+        if self.maxRate is not None:
+            now = time.monotonic()
+            while self.recent and self.recent[0] <= now - 1:
+                self.recent.popleft()
+            if len(self.recent) >= self.maxRate:
+                return "rate limit"
+            self.recent.append(now)
+        r = random.random()
+        for fault, p in (
+            ("drop", self.drop),
+            ("rate limit", self.rateLimited),
+            ("malformed", self.malformed),
+            ("missing keys", self.missingKeys),
+        ):
+            if r < p:
+                return fault
+            r -= p
+        return None
+
+    async def handle(self, target, headers):
+        # answers requests of the form /cdb.php?action=...&board=...&json=1
+        parts = urllib.parse.urlsplit(target)
+        if parts.path in ("/metrics", "/metrics.json"):
+            return await self.metrics.handle(target, headers)
+        params = dict(urllib.parse.parse_qsl(parts.query, keep_blank_values=True))
+        action, fen = params.get("action"), params.get("board")
+        if action not in ACTIONS or not fen:
+            return 400, "text/plain", b"Unsupported request\n"
+        self.metrics.inc("cdbmock_requests_total", action=action)
+        await asyncio.sleep(self.latency())
+        fault = self.fault()
+        if fault is not None:
+            self.metrics.inc("cdbmock_faults_total", fault=fault)
+        if fault == "drop":
+            return None
+        if fault == "rate limit":
+            content = {"status": "rate limit exceeded"}
+        else:
+            fen, _, moves = fen.partition(" moves ")
+            try:
+                board = chess.Board(fen)
+                for move in moves.split():
+                    board.push_uci(move)
+                valid = board.is_valid()
+            except ValueError:
+                valid = False
+            if valid:
+                content = self.reply(action, board, params)
+            else:
+                content = {"status": "invalid board"}
+        if fault == "missing keys" and content.get("status") == "ok":
+            content = {"status": "ok"}
+        body = json.dumps(content).encode()
+        if fault == "malformed":
+            body = body[: len(body) // 2]
+        return 200, "application/json", body
+
+    def stats(self):
+        counters = self.metrics.json()["counters"]
+        served = counters.get("cdbmock_requests_total", {})
+        faults = counters.get("cdbmock_faults_total", {})
+
+        def text(d):
+            return ", ".join(f"{k.split('=')[1]}: {v:g}" for k, v in d.items())
+
+        return (
+            f"Served {text(served) or 'no requests'}. Faults {text(faults) or 'none'}."
+        )
+
+    async def serve(self, host, port, statsInterval):
+        server = await cdblib.start_http_server(self.handle, host, port)
+        host, port = server.sockets[0].getsockname()[:2]
+        print(
+            f"Serving at http://{host}:{port}/cdb.php, clients can use it with\n"
+            f"  export CDBLIB_ENDPOINTS=http://{host}:{port}/cdb.php",
+            file=sys.stderr,
+            flush=True,
+        )
+        async with server:
+            while True:
+                await asyncio.sleep(statsInterval if statsInterval > 0 else 3600)
+                if statsInterval > 0:
+                    print(
+                        f"{datetime.now().isoformat()}: {self.stats()}",
+                        file=sys.stderr,
+                        flush=True,
+                    )
+
+
+async def main():
+    parser = argparse.ArgumentParser(
+        description="A local stand-in for chessdb.cn, to test and load-test the cdblib scripts offline by setting CDBLIB_ENDPOINTS to its URL. Its scores are synthetic, or come from scored EPD files, and its replies can be delayed and made to fail in the ways that cdblib has to cope with.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        "--host",
+        help="Address to listen on.",
+        default="127.0.0.1",
+    )
+    parser.add_argument(
+        "-p",
+        "--port",
+        help="Port to listen on.",
+        type=int,
+        default=8000,
+    )
+    parser.add_argument(
+        "--latency",
+        help='Distribution of the reply latency in seconds: "const:T", "uniform:A,B", "exp:MEAN", "lognormal:MEDIAN,SIGMA" or "pareto:MIN,ALPHA".',
+        default="const:0",
+    )
+    parser.add_argument(
+        "--rateLimited",
+        help='Fraction of requests that get a "rate limit exceeded" reply.',
+        type=float,
+        default=0,
+    )
+    parser.add_argument(
+        "--maxRate",
+        help='Maximum number of requests per second, further requests get a "rate limit exceeded" reply.',
+        type=float,
+        default=None,
+    )
+    parser.add_argument(
+        "--malformed",
+        help="Fraction of replies with truncated json.",
+        type=float,
+        default=0,
+    )
+    parser.add_argument(
+        "--missingKeys",
+        help='Fraction of "ok" replies that only contain the status.',
+        type=float,
+        default=0,
+    )
+    parser.add_argument(
+        "--drop",
+        help="Fraction of requests for which the connection is closed without a reply.",
+        type=float,
+        default=0,
+    )
+    parser.add_argument(
+        "--unknownFraction",
+        help="Fraction of positions with synthetic scores that are unknown until queued.",
+        type=float,
+        default=0.1,
+    )
+    parser.add_argument(
+        "--queueDelay",
+        help="Time in seconds after which a queued position becomes known.",
+        type=float,
+        default=5,
+    )
+    parser.add_argument(
+        "--oracle",
+        action="append",
+        help="A file with scored EPDs in the output format of fens2cdb.py, whose positions replace the synthetic ones. May be given several times.",
+    )
+    parser.add_argument(
+        "--oracleIndex",
+        help="Filename for a persistent index of the oracle files, which is only rebuilt if they change. Otherwise the index is kept in memory.",
+        default=None,
+    )
+    parser.add_argument(
+        "--seed",
+        help="Seed for the random latencies and faults.",
+        type=int,
+        default=None,
+    )
+    parser.add_argument(
+        "--statsInterval",
+        help="Interval in seconds for printing statistics, 0 for never.",
+        type=float,
+        default=60,
+    )
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    mock = cdbmock(
+        args.latency,
+        args.rateLimited,
+        args.maxRate,
+        args.malformed,
+        args.missingKeys,
+        args.drop,
+        args.unknownFraction,
+        args.queueDelay,
+        args.oracle,
+        args.oracleIndex,
+    )
+    await mock.serve(args.host, args.port, args.statsInterval)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
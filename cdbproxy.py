@@ -0,0 +1,198 @@
+"""
+   Local caching proxy for chessdb.cn, to be shared by all the cdblib scripts.
+"""
+import argparse, asyncio, json, sys, urllib.parse, cdblib
+from datetime import datetime
+
+ACTIONS = ("queryall", "querybest", "query", "querysearch", "queryscore")
+ACTIONS += ("querypv", "queue")
+
+
+class cdbproxy:
+    def __init__(
+        self,
+        concurrency,
+        user=None,
+        suppressErrors=False,
+        transport="requests",
+        rateLimit=None,
+        cache=None,
+        maxAge=60,
+        upstream=None,
+        prefillChildren=False,
+        prefillPVs=False,
+    ):
+        if cache is None or isinstance(cache, str):
+            cache = cdblib.ResponseCache(
+                ":memory:" if cache is None else cache,
+                prefillChildren=prefillChildren,
+                prefillPVs=prefillPVs,
+            )
+        # cap the time-to-live of all cached replies, so that clients that
+        # poll or walk cdb get to see its updates
+        cache.ttl = {k: min(v, maxAge) for k, v in cache.ttl.items()}
+        self.cdb = cdblib.cdbAPI(
+            concurrency,
+            "cdbproxy" + bool(user) * "/" + (user or ""),
+            not suppressErrors,
+            transport=transport,
+            rateLimit=rateLimit,
+            cache=cache,
+            endpoints=upstream or [cdblib.CDB_URL],
+        )
+        self.served = cdblib.AtomicInteger()
+        self.failed = cdblib.AtomicInteger()
+
+    async def handle(self, target, headers):
+        # answers requests of the form /cdb.php?action=...&board=...&json=1
+        parts = urllib.parse.urlsplit(target)
+        metrics = self.cdb.metrics
+        if parts.path in ("/metrics", "/metrics.json") or parts.path in metrics.pages:
+            return await metrics.handle(target, headers)
+        query = urllib.parse.parse_qsl(parts.query, keep_blank_values=True)
+        params = dict(query)
+        action, fen = params.get("action"), params.get("board")
+        if action not in ACTIONS or not fen:
+            return 400, "text/plain", b"Unsupported request\n"
+        # the remaining parameters, in the order in which cdbAPI sends them
+        optionString = "".join(
+            f"&{k}={v}" for k, v in query if k not in ("action", "board", "json")
+        )
+        self.served.inc()
+        try:
+            # the clients' priorities are not sent, so every request gets the
+            # default priority of its action
+            content = await self.cdb.generic_call(action, fen, optionString)
+        except cdblib.RetryBudgetExceeded:
+            self.failed.inc()
+            return 502, "text/plain", b"No reply from upstream\n"
+        content.pop("fen", None)
+        return 200, "application/json", json.dumps(content).encode()
+
+    def stats(self):
+        served, cdb = self.served.get(), self.cdb
+        upstream = cdb.requested.get() - cdb.coalesced.get()
+        return (
+            f"Served {served} requests ({self.failed.get()} failed) with "
+            f"{upstream} upstream requests, {cdb.coalesced.get()} merged "
+            f"in flight. {cdb.cache.stats()}"
+        )
+
+    async def serve(self, host, port, statsInterval):
+        server = await cdblib.start_http_server(self.handle, host, port)
+        host, port = server.sockets[0].getsockname()[:2]
+        print(
+            f"Serving at http://{host}:{port}/cdb.php, clients can use it with\n"
+            f"  export CDBLIB_ENDPOINTS=http://{host}:{port}/cdb.php",
+            file=sys.stderr,
+            flush=True,
+        )
+        async with server:
+            while True:
+                await asyncio.sleep(statsInterval if statsInterval > 0 else 3600)
+                if statsInterval > 0:
+                    print(
+                        f"{datetime.now().isoformat()}: {self.stats()}",
+                        file=sys.stderr,
+                        flush=True,
+                    )
+
+
+async def main():
+    parser = argparse.ArgumentParser(
+        description="A local proxy for chessdb.cn that the cdblib scripts on this host can share by setting CDBLIB_ENDPOINTS to its URL. It keeps a common cache of cdb's replies, merges identical requests from different clients, applies a single rate limit and uses one pool of connections to cdb. The clients' request priorities do not reach the proxy, which sends queue requests with background and all others with normal priority.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        "--host",
+        help="Address to listen on.",
+        default="127.0.0.1",
+    )
+    parser.add_argument(
+        "-p",
+        "--port",
+        help="Port to listen on.",
+        type=int,
+        default=8765,
+    )
+    parser.add_argument(
+        "-c",
+        "--concurrency",
+        help="Maximum concurrency of requests to cdb.",
+        type=int,
+        default=16,
+    )
+    parser.add_argument(
+        "--rateLimit",
+        help="Maximum number of requests per second to cdb.",
+        type=float,
+        default=None,
+    )
+    parser.add_argument(
+        "--cache",
+        help="Filename of a persistent SQLite cache for cdb's replies, otherwise the cache is kept in memory.",
+        default=None,
+    )
+    parser.add_argument(
+        "--maxAge",
+        help="Maximal time in seconds for which a cached reply is served to clients.",
+        type=float,
+        default=60,
+    )
+    parser.add_argument(
+        "--prefillChildren",
+        action="store_true",
+        help="Use the move scores in queryall/showall replies to answer queryscore requests with learn=0 for the child positions.",
+    )
+    parser.add_argument(
+        "--prefillPVs",
+        action="store_true",
+        help="Use the PVs in querypv replies to also answer stable PV requests for the positions along these PVs.",
+    )
+    parser.add_argument(
+        "--statsInterval",
+        help="Interval in seconds for printing statistics, 0 for never.",
+        type=float,
+        default=300,
+    )
+    parser.add_argument(
+        "--upstream",
+        help="Comma separated list of URLs of cdb's API that the proxy forwards to. CDBLIB_ENDPOINTS is ignored, so that it may point to the proxy itself.",
+        default=cdblib.CDB_URL,
+    )
+    parser.add_argument(
+        "--transport",
+        choices=["requests", "asyncio"],
+        default="asyncio",
+        help="HTTP backend: blocking requests in a thread pool, or native asyncio.",
+    )
+    parser.add_argument(
+        "-u",
+        "--user",
+        help="Add this username to the http user-agent header.",
+    )
+    parser.add_argument(
+        "-s",
+        "--suppressErrors",
+        action="store_true",
+        help="Suppress error messages from cdblib.",
+    )
+    args = parser.parse_args()
+
+    proxy = cdbproxy(
+        args.concurrency,
+        args.user,
+        args.suppressErrors,
+        args.transport,
+        args.rateLimit,
+        args.cache,
+        args.maxAge,
+        args.upstream.replace(",", " ").split(),
+        args.prefillChildren,
+        args.prefillPVs,
+    )
+    await proxy.serve(args.host, args.port, args.statsInterval)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
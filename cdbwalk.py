@@ -38,6 +38,8 @@ class cdbwalk:
         concurrency,
         user,
         suppressErrors,
+        rateLimit=None,
+        rateWeight=1,
     ):
         self.filename = filename
         self.isPGN = filename.endswith(".pgn") or filename.endswith(".pgn.gz")
@@ -47,20 +49,28 @@ class cdbwalk:
         self.depthLimit = depthLimit
         self.TBwalk = TBwalk
         self.concurrency = concurrency
-        self.cdb = cdblib.cdbAPI(concurrency, user, not suppressErrors)
+        self.cdb = cdblib.cdbAPI(
+            concurrency,
+            user,
+            not suppressErrors,
+            rateLimit=rateLimit,
+            rateWeight=rateWeight,
+        )
 
     def reload(self):
         self.metalist = []
         if self.isPGN:
             pgn = cdblib.open_file_rt(self.filename)
-            while game := chess.pgn.read_game(pgn):
-                self.metalist.append(game)
+            with cdblib.PROFILER.stage("parse"):
+                while game := chess.pgn.read_game(pgn):
+                    self.metalist.append(game)
             print(
                 f"Read {len(self.metalist)} (opening) lines from file {self.filename}.",
                 flush=True,
             )
         else:
-            with cdblib.open_file_rt(self.filename) as f:
+            load = cdblib.PROFILER.stage("load")
+            with load, cdblib.open_file_rt(self.filename) as f:
                 for line in f:
                     line = line.strip()
                     if line:
@@ -95,7 +105,8 @@ class cdbwalk:
             for parse_line in tasks:
                 p = await parse_line
                 if p:
-                    print(p)
+                    with cdblib.PROFILER.stage("write"):
+                        print(p)
 
         elapsed = time.time() - self.tic
         print(
@@ -104,10 +115,11 @@ class cdbwalk:
 
     async def parse_single_line(self, lineIdx):
         line = self.metalist[lineIdx]
-        if self.isPGN:
-            board = line.end().board()
-        else:
-            board = chess.Board(line)
+        with cdblib.PROFILER.stage("replay"):
+            if self.isPGN:
+                board = line.end().board()
+            else:
+                board = chess.Board(line)
         r = await self.cdb.showall(board.epd())
         score = cdblib.json2eval(r)
         retStr = ""
@@ -130,17 +142,18 @@ class cdbwalk:
                     retStr += f"1... "
         ply = ply0
         while "moves" in r and ply - ply0 < self.depthLimit:
-            m = select_move(r["moves"], temp=self.moveTemp)
-            move = chess.Move.from_uci(m)
-            if self.verbose:
-                if board.turn == chess.WHITE:
-                    retStr += f"{(ply+2) // 2}. "
-                retStr += f"{str(board.san(move))} "
-                if ply == ply0:
-                    url += " moves"
-                url += " " + m
-            board.push(move)
-            ply += 1
+            with cdblib.PROFILER.stage("walk"):
+                m = select_move(r["moves"], temp=self.moveTemp)
+                move = chess.Move.from_uci(m)
+                if self.verbose:
+                    if board.turn == chess.WHITE:
+                        retStr += f"{(ply+2) // 2}. "
+                    retStr += f"{str(board.san(move))} "
+                    if ply == ply0:
+                        url += " moves"
+                    url += " " + m
+                board.push(move)
+                ply += 1
             if board.can_claim_draw() or board.is_insufficient_material():
                 r = {}
                 if self.verbose:
@@ -210,6 +223,18 @@ async def main():
         type=int,
         default=16,
     )
+    parser.add_argument(
+        "--rateLimit",
+        help="Maximum number of requests per second to cdb, shared by all the cdblib scripts on this host that use this option.",
+        type=float,
+        default=None,
+    )
+    parser.add_argument(
+        "--rateWeight",
+        help="Weight of this process in the split of the shared rate limit.",
+        type=float,
+        default=1,
+    )
     parser.add_argument(
         "-b",
         "--batchSize",
@@ -238,7 +263,13 @@ async def main():
         help="Run the script in an infinite loop.",
     )
 
+    parser.add_argument(
+        "--profile",
+        help="Write a profile of the run to this file: the time spent in the local stages and waiting for cdb, a CPU profile and the peak memory.",
+        default=None,
+    )
     args = parser.parse_args()
+    cdblib.PROFILER.start(args.profile)
 
     walk = cdbwalk(
         args.filename,
@@ -250,6 +281,8 @@ async def main():
         args.concurrency,
         args.user,
         args.suppressErrors,
+        args.rateLimit,
+        args.rateWeight,
     )
     if args.loops <= 0:
         parser.error("--loops must be a positive integer")
@@ -15,11 +15,21 @@ class fens2cdb:
         concurrency,
         user,
         suppressErrors,
+        transport="requests",
+        minConcurrency=None,
+        maxConcurrency=None,
+        rateLimit=None,
+        rateWeight=1,
+        hedgeFraction=0,
+        cache=None,
+        oracle=None,
+        oracleIndex=None,
+        offline=False,
     ):
         self.input = filename
         self.lines = []
         self.scored = 0
-        with cdblib.open_file_rt(filename) as f:
+        with cdblib.PROFILER.stage("load"), cdblib.open_file_rt(filename) as f:
             for line in f:
                 line = line.strip()
                 if line:
@@ -43,7 +53,28 @@ class fens2cdb:
         self.shortFormat = shortFormat
         self.enqueue = enqueue
         self.concurrency = concurrency
-        self.cdb = cdblib.cdbAPI(concurrency, user, not suppressErrors)
+        if oracle:
+            oracle = cdblib.EPDOracle(oracle, oracleIndex or ":memory:")
+            if self.display:
+                print(
+                    f"Read {len(oracle)} scored positions from the oracle files.",
+                    file=self.display,
+                    flush=True,
+                )
+        self.cdb = cdblib.cdbAPI(
+            concurrency,
+            user,
+            not suppressErrors,
+            transport,
+            minConcurrency=minConcurrency,
+            maxConcurrency=maxConcurrency,
+            rateLimit=rateLimit,
+            rateWeight=rateWeight,
+            hedgeFraction=hedgeFraction,
+            cache=cache,
+            oracle=oracle,
+            offline=offline,
+        )
         self.unknown = cdblib.AtomicInteger()
 
     async def parse_all(self, batchSize=None):
@@ -63,13 +94,31 @@ class fens2cdb:
                 tasks.append(asyncio.create_task(self.parse_single_line(line)))
 
             for parse_line in tasks:
-                print(await parse_line, file=self.output)
+                line = await parse_line
+                with cdblib.PROFILER.stage("write"):
+                    print(line, file=self.output)
 
         if self.display:
             elapsed = time.time() - self.tic
             print(
                 f"Done. Scored {self.scored} FENs in {elapsed:.1f}s.", file=self.display
             )
+            if self.cdb.cache is not None:
+                print(self.cdb.cache.stats(), file=self.display)
+            if self.cdb.oracle is not None:
+                print(self.cdb.oracle.stats(), file=self.display)
+            breaker = self.cdb.circuitBreaker
+            if breaker is not None and breaker.stateTime[breaker.OPEN]:
+                times = breaker.times()
+                print(
+                    f"Paused for {times[breaker.OPEN]:.1f}s during server outages, and ramped up again for {times[breaker.HALF_OPEN]:.1f}s.",
+                    file=self.display,
+                )
+            if self.cdb.limiter.adaptive:
+                print(
+                    f"Final adaptive concurrency: {self.cdb.concurrencyLimit}.",
+                    file=self.display,
+                )
             if self.unknown.get():
                 print(
                     f"The file {self.input} contained {self.unknown.get()} new chessdb.cn positions.",
@@ -112,18 +161,19 @@ class fens2cdb:
                         timeout = min(timeout * 1.5, 120)
         if score == "":
             return line
-        if self.shortFormat:
-            if score == "mated":
-                score = "#"
-            elif type(score) != int:
-                _, M, ply = score.partition("M")
-                if M == "" or not ply.isnumeric():
-                    score = ""
-        else:
-            if "ply" in r:
-                score = f"{score}, ply: {r['ply']}"
-            score = f"cdb eval: {score}"
-        return f"{line}{' ;' if line[-1] != ';' else ''} {score};"
+        with cdblib.PROFILER.stage("format"):
+            if self.shortFormat:
+                if score == "mated":
+                    score = "#"
+                elif type(score) != int:
+                    _, M, ply = score.partition("M")
+                    if M == "" or not ply.isnumeric():
+                        score = ""
+            else:
+                if "ply" in r:
+                    score = f"{score}, ply: {r['ply']}"
+                score = f"cdb eval: {score}"
+            return f"{line}{' ;' if line[-1] != ';' else ''} {score};"
 
 
 async def main():
@@ -159,6 +209,56 @@ async def main():
         type=int,
         default=16,
     )
+    parser.add_argument(
+        "--minConcurrency",
+        help="Lower bound for adaptive concurrency (enables adaptive concurrency, starting from CONCURRENCY).",
+        type=int,
+        default=None,
+    )
+    parser.add_argument(
+        "--maxConcurrency",
+        help="Upper bound for adaptive concurrency (enables adaptive concurrency, starting from CONCURRENCY).",
+        type=int,
+        default=None,
+    )
+    parser.add_argument(
+        "--rateLimit",
+        help="Maximum number of requests per second to cdb, shared by all the cdblib scripts on this host that use this option.",
+        type=float,
+        default=None,
+    )
+    parser.add_argument(
+        "--rateWeight",
+        help="Weight of this process in the split of the shared rate limit.",
+        type=float,
+        default=1,
+    )
+    parser.add_argument(
+        "--hedgeFraction",
+        help="Maximal fraction of read-only requests that may be duplicated if they are slower than usual, to cut tail latency. Duplicates only use idle connections and rate limit tokens, but each one is an extra request to cdb.",
+        type=float,
+        default=0,
+    )
+    parser.add_argument(
+        "--cache",
+        help="Filename of a persistent SQLite cache for cdb's replies, which may be shared between runs and scripts. Only read-only requests are answered from it, so it gives hits only with --suppressLearning.",
+        default=None,
+    )
+    parser.add_argument(
+        "--oracle",
+        action="append",
+        help="A file with scored EPDs in the output format of fens2cdb.py, whose evals are used instead of querying cdb. May be given several times.",
+    )
+    parser.add_argument(
+        "--oracleIndex",
+        help="Filename for a persistent index of the oracle files, which is only rebuilt if they change. Otherwise the index is kept in memory.",
+        default=None,
+    )
+    parser.add_argument(
+        "--offline",
+        action="store_true",
+        help="Only use the oracle files, and never query cdb.",
+    )
     parser.add_argument(
         "-b",
         "--batchSize",
@@ -177,12 +277,24 @@ async def main():
         action="store_true",
         help="Suppress error messages from cdblib.",
     )
+    parser.add_argument(
+        "--transport",
+        choices=["requests", "asyncio"],
+        default="requests",
+        help="HTTP backend: blocking requests in a thread pool, or native asyncio.",
+    )
     parser.add_argument(
         "--suppressLearning",
         action="store_true",
         help="Suppress cdb's automatic learning.",
     )
+    parser.add_argument(
+        "--profile",
+        help="Write a profile of the run to this file: the time spent in the local stages and waiting for cdb, a CPU profile and the peak memory.",
+        default=None,
+    )
     args = parser.parse_args()
+    cdblib.PROFILER.start(args.profile)
 
     if args.suppressLearning:
         if args.enqueue:
@@ -192,6 +304,11 @@ async def main():
             )
             quit()
         args.enqueue = -1
+    if args.offline and (args.enqueue > 0 or not args.oracle):
+        print(
+            "Option --offline needs --oracle, and excludes --enqueue.", file=sys.stderr
+        )
+        quit()
 
     f2c = fens2cdb(
         args.input,
@@ -202,6 +319,16 @@ async def main():
         args.concurrency,
         args.user,
         args.suppressErrors,
+        args.transport,
+        args.minConcurrency,
+        args.maxConcurrency,
+        args.rateLimit,
+        args.rateWeight,
+        args.hedgeFraction,
+        args.cache,
+        args.oracle,
+        args.oracleIndex,
+        args.offline,
     )
 
     await f2c.parse_all(args.batchSize)
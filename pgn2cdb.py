@@ -7,30 +7,47 @@ import argparse, asyncio, logging, time, chess, chess.pgn, cdblib
 
 class dbcache:
     # local cache for cdbAPI responses that avoids duplicate queries to API
-    def __init__(self, concurrency, user=False, suppressErrors=False):
-        self.cdbAPI = cdblib.cdbAPI(concurrency, user, not suppressErrors)
-        self.cache = cdblib.AtomicDict()
+    # cacheSize bounds the number of cached positions, where those with a
+    # distance of at most protectPly from cdb's root are evicted last
+    def __init__(
+        self,
+        concurrency,
+        user=False,
+        suppressErrors=False,
+        cacheSize=10**6,
+        protectPly=20,
+        oracle=None,
+    ):
+        # typed replies take less memory in the cache than dicts
+        self.cdbAPI = cdblib.cdbAPI(
+            concurrency, user, not suppressErrors, oracle=oracle, typed=True
+        )
+        self.cache = cdblib.LRUCache(cacheSize)
+        self.protectPly = protectPly
         self.req_received = cdblib.AtomicInteger()
         self.req_cached = cdblib.AtomicInteger()
         self.queued = cdblib.AtomicInteger()
 
-    async def get(self, fen):
+    async def get(self, fen, key=None):
         """queryscore from API, use cached result if possible"""
+        # key is a compact substitute for fen in the cache, e.g. a Zobrist key
+        key = fen if key is None else key
         self.req_received.inc()
-        r = self.cache.get(fen)
+        r = self.cache.get(key)
         if r is not None:
             self.req_cached.inc()
         else:
             # returns dictionary with keys "status", "eval" and possibly "ply"
             r = await self.cdbAPI.queryscore(fen)
-            self.cache.set(fen, r)
+            self.cache.set(key, r, 0 <= r.get("ply", -1) <= self.protectPly)
         return r
 
-    async def queue(self, fen):
+    async def queue(self, fen, key=None):
         """queue fen via API, add entry to cache as well"""
         asyncio.ensure_future(self.cdbAPI.queue(fen))
         self.queued.inc()
-        self.cache.set(fen, {"status": "ok"})  # assume fen is in cdb from now on
+        key = fen if key is None else key
+        self.cache.set(key, {"status": "ok"})  # assume fen is in cdb from now on
 
 
 class pgn2cdb:
@@ -44,6 +61,9 @@ class pgn2cdb:
         concurrency,
         user,
         suppressErrors,
+        cacheSize=10**6,
+        oracle=None,
+        oracleIndex=None,
     ):
         self.filename = filename
         self.verbose = verbose
@@ -54,20 +74,27 @@ class pgn2cdb:
         pgn = cdblib.open_file_rt(self.filename)
         logging.getLogger("chess.pgn").setLevel(logging.CRITICAL)
         self.gamelist = []
-        while game := chess.pgn.read_game(pgn):
-            for e in game.errors:
-                if isinstance(e, chess.IllegalMoveError):
-                    move = str(e).split(":")[-1].strip()
-                    print(f"Ignoring illegal move {move}")
-                    if self.verbose >= 2:
-                        print(f"----- affected game -------\n{game}")
-                        print(f"---------------------------")
-                else:
-                    print(f'Encountered error "{e}". Will try to continue.')
-            self.gamelist.append(game)
+        with cdblib.PROFILER.stage("parse"):
+            while game := chess.pgn.read_game(pgn):
+                for e in game.errors:
+                    if isinstance(e, chess.IllegalMoveError):
+                        move = str(e).split(":")[-1].strip()
+                        print(f"Ignoring illegal move {move}")
+                        if self.verbose >= 2:
+                            print(f"----- affected game -------\n{game}")
+                            print(f"---------------------------")
+                    else:
+                        print(f'Encountered error "{e}". Will try to continue.')
+                self.gamelist.append(game)
         self.gn = len(self.gamelist)
         print(f"Read {self.gn} pgns from file {self.filename}.", flush=True)
-        self.db = dbcache(self.concurrency, user, not suppressErrors)
+        if oracle:
+            with cdblib.PROFILER.stage("load"):
+                oracle = cdblib.EPDOracle(oracle, oracleIndex or ":memory:")
+            print(f"Read {len(oracle)} scored positions from the oracle files.")
+        self.db = dbcache(
+            self.concurrency, user, not suppressErrors, cacheSize, oracle=oracle
+        )
         self.seen = cdblib.AtomicInteger()
         self.painted = cdblib.AtomicInteger()
 
@@ -88,7 +115,8 @@ class pgn2cdb:
             for parse_line in tasks:
                 p = await parse_line
                 if p:
-                    print(p, end="")
+                    with cdblib.PROFILER.stage("write"):
+                        print(p, end="")
 
         elapsed = time.time() - self.tic
         print(
@@ -104,6 +132,16 @@ class pgn2cdb:
         print(
             f"Queued {q} new positions to chessdb.cn. Local cache hit rate: {c}/{r} = {c/max(r,1)*100:.2f}%."
         )
+        if self.db.cdbAPI.oracle is not None:
+            print(self.db.cdbAPI.oracle.stats())
+        ev = self.db.cache.evictions
+        if ev:
+            print(f"Evicted {ev} positions from the full local cache.")
+        co = self.db.cdbAPI.coalesced.get()
+        if co:
+            print(
+                f"Merged {co}/{self.db.cdbAPI.requested.get()} API calls with identical in-flight requests."
+            )
         if self.paint:
             p = self.painted.get()
             if p:
@@ -116,24 +154,25 @@ class pgn2cdb:
                 )
 
     async def parse_single_line(self, lineIdx):
-        line = self.gamelist[lineIdx]
-        board = line.board()
-        retStr = ""
-        if self.verbose >= 4:
-            retStr += f"    pgn {lineIdx+1}/{self.gn}: {str(line.mainline_moves())}\n"
-        plies, pc = 0, 32
-        for move in line.mainline_moves():
-            if self.verbose >= 3:
+        with cdblib.PROFILER.stage("replay"):
+            line = self.gamelist[lineIdx]
+            board = cdblib.ZobristBoard(line.board().fen())
+            retStr = ""
+            if self.verbose >= 4:
                 retStr += (
-                    f"    pgn {lineIdx+1}/{self.gn}, ply {plies+1:3d}: {str(move)}\n"
+                    f"    pgn {lineIdx+1}/{self.gn}: {str(line.mainline_moves())}\n"
                 )
-            board.push(move)
-            plies += 1
-            pc = chess.popcount(board.occupied)  # piece count
-            if plies >= self.depth or pc <= 7:
-                break  # cdb only stores pos if >= 8
-        if self.verbose:
-            retStr += f"  For pgn {lineIdx+1}/{self.gn} read {plies}/{self.depth} plies. Final position has {pc} pieces.\n"
+            plies, pc = 0, 32
+            for move in line.mainline_moves():
+                if self.verbose >= 3:
+                    retStr += f"    pgn {lineIdx+1}/{self.gn}, ply {plies+1:3d}: {str(move)}\n"
+                board.push(move)
+                plies += 1
+                pc = chess.popcount(board.occupied)  # piece count
+                if plies >= self.depth or pc <= 7:
+                    break  # cdb only stores pos if >= 8
+            if self.verbose:
+                retStr += f"  For pgn {lineIdx+1}/{self.gn} read {plies}/{self.depth} plies. Final position has {pc} pieces.\n"
 
         if board.is_checkmate() or board.is_stalemate() or pc <= 7:
             # mates, stalemates and 7men are not stored as nodes on chessdb.cn
@@ -150,7 +189,7 @@ class pgn2cdb:
             board.pop()
             plies -= 1
 
-        r = await self.db.get(board.epd())
+        r = await self.db.get(board.epd(), board.zobrist)
         cdbply = r.get("ply", -1)
         if r["status"] == "ok":
             self.seen.inc()
@@ -169,7 +208,7 @@ class pgn2cdb:
             if r["status"] == "unknown":
                 if not new_fens and self.verbose >= 2:
                     retStr += f"    Queueing new positions from ply {plies} ... \n"
-                asyncio.ensure_future(self.db.queue(board.epd()))
+                asyncio.ensure_future(self.db.queue(board.epd(), board.zobrist))
                 new_fens = True
             elif new_fens:
                 if self.verbose >= 2:
@@ -178,7 +217,7 @@ class pgn2cdb:
             if plies > 0:
                 move = board.pop()
                 poppedMoves.append(move)
-                r = await self.db.get(board.epd())
+                r = await self.db.get(board.epd(), board.zobrist)
                 cdbply = r.get("ply", -1)
             plies -= 1
             if self.verbose >= 4:
@@ -248,6 +287,22 @@ async def main():
         type=int,
         default=16,
     )
+    parser.add_argument(
+        "--cacheSize",
+        help="Maximum number of positions kept in the local cache.",
+        type=int,
+        default=10**6,
+    )
+    parser.add_argument(
+        "--oracle",
+        action="append",
+        help="A file with scored EPDs in the output format of fens2cdb.py, whose evals are used instead of querying cdb, e.g. to check if a position is connected to the root. May be given several times.",
+    )
+    parser.add_argument(
+        "--oracleIndex",
+        help="Filename for a persistent index of the oracle files, which is only rebuilt if they change. Otherwise the index is kept in memory.",
+        default=None,
+    )
     parser.add_argument(
         "-b",
         "--batchSize",
@@ -266,7 +321,13 @@ async def main():
         action="store_true",
         help="Suppress error messages from cdblib.",
     )
+    parser.add_argument(
+        "--profile",
+        help="Write a profile of the run to this file: the time spent in the local stages and waiting for cdb, a CPU profile and the peak memory.",
+        default=None,
+    )
     args = parser.parse_args()
+    cdblib.PROFILER.start(args.profile)
     p2c = pgn2cdb(
         args.filename,
         args.verbose,
@@ -276,6 +337,9 @@ async def main():
         args.concurrency,
         args.user,
         args.suppressErrors,
+        args.cacheSize,
+        args.oracle,
+        args.oracleIndex,
     )
     await p2c.parse_all(args.batchSize)
 
@@ -0,0 +1,100 @@
+"""
+   Regression tests for cdblib, run with "python -m pytest tests".
+"""
+import asyncio, os, sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import cdblib
+
+FEN = "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq -"
+
+
+class FakeTransport:
+    # answers every request with "unknown" after latency seconds
+    def __init__(self, latency=0.05):
+        self.latency = latency
+        self.urls = []
+
+    async def get(self, url, timeout, timing=None):
+        self.urls.append(url)
+        await asyncio.sleep(self.latency)
+        return b'{"status": "unknown"}'
+
+
+def fake_api(**kwargs):
+    return cdblib.cdbAPI(
+        4,
+        showErrors=False,
+        transport=FakeTransport(),
+        endpoints=["http://cdb.test/cdb.php"],
+        metrics=cdblib.Metrics(),
+        inspector=cdblib.RequestInspector(),
+        **kwargs,
+    )
+
+
+def test_call_after_abandoned_coalesced_call():
+    # a caller that arrives while the abandoned request is being cancelled
+    # must get a request of its own, and not its CancelledError
+    async def main():
+        api = fake_api()
+        first = asyncio.ensure_future(api.showall(FEN))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        await asyncio.sleep(0)
+        content = await api.showall(FEN)
+        assert content["status"] == "unknown"
+        assert not api.inflight
+
+    asyncio.run(main())
+
+
+def test_first_retry_delays_vary():
+    # the first retries of many requests must not fire at the same moment
+    policy = cdblib.RetryPolicy()
+    for reason in (policy.NETWORK, policy.TIMEOUT, policy.RATELIMIT):
+        base, cap = policy.backoff[reason]
+        delays = [policy.delay(reason, 0) for _ in range(100)]
+        assert all(base <= d <= cap for d in delays)
+        assert len(set(delays)) > 90
+
+
+RATE_WORKER = """
+import asyncio, sys, time
+sys.path.insert(0, sys.argv[1])
+import cdblib
+
+async def main(filename, start, deadline):
+    limiter, n = cdblib.SharedRateLimiter(40, filename), 0
+    await limiter.acquire()  # joins the split, then stays idle until start
+    await asyncio.sleep(start - time.time())
+    while True:
+        await limiter.acquire()
+        if time.time() >= deadline:
+            break
+        n += 1
+    print(n)
+
+asyncio.run(main(sys.argv[2], float(sys.argv[3]), float(sys.argv[4])))
+"""
+
+
+def test_shared_rate_limit_across_processes(tmp_path):
+    # two processes that share a budget of 40 requests/s stay within it, also
+    # after an idle time in which they must not bank any burst credit
+    import subprocess, time
+
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    filename, duration = str(tmp_path / "ratelimit.json"), 3
+    start = time.time() + 2
+    args = [root, filename, str(start), str(start + duration)]
+    workers = [
+        subprocess.Popen(
+            [sys.executable, "-c", RATE_WORKER] + args,
+            stdout=subprocess.PIPE,
+            text=True,
+        )
+        for _ in range(2)
+    ]
+    total = sum(int(w.communicate()[0]) for w in workers)
+    assert 40 * duration * 0.8 <= total <= 40 * duration + 2